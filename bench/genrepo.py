@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Generates a synthetic lxpkg repository with source tarballs and fake build scripts.
+# Usage: python3 bench/genrepo.py WORKDIR [--packages N] [--base-url URL] ...
+import io
+import os
+import json
+import random
+import shutil
+import tarfile
+import hashlib
+import argparse
+
+WORDS = ("lib", "gcc", "python", "perl", "rust", "glib", "gtk", "xorg", "mesa", "font", "util", "linux",
+         "ssl", "curl", "zlib", "xz", "bz", "ncurses", "readline", "sqlite", "dbus", "pango", "cairo", "qt")
+SECTIONS = ("core", "extra", "xorg", "lib")
+
+DEFAULTS = {
+    "packages": 2000,     # general packages with random dependencies on earlier ones
+    "depth": 200,         # length of the deep-* dependency chain
+    "wide": 500,          # dependencies of the "wide" package
+    "cluster": 40,        # app-* packages pulled in by the "app" install target
+    "huge_files": 20000,  # files shipped by the "huge" package
+    "source_files": 8,    # files in every other source tarball
+    "build_time": 0.0,    # seconds each fake build sleeps
+    "seed": 0,
+    "base_url": "http://127.0.0.1:8766",
+}
+
+def build_script(name, build_time):
+    # Fake build: the "compiled" package is just the source tree copied into the destination
+    sleep = f"sleep {build_time}\n" if build_time else ""
+    return f'{sleep}mkdir -p "$1/usr/share/{name}"\ncp -r . "$1/usr/share/{name}/"\n'
+
+def make_tarball(path, name, files, rng):
+    with tarfile.open(path, "w:gz", compresslevel=1) as tar:
+        for i in range(files):
+            data = (f"{name} file {i}\n" * rng.randint(1, 64)).encode()
+            info = tarfile.TarInfo(f"{name}-1.0/src/{i // 1000}/file{i}.txt")
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+
+def write_recipe(repo, dist, section, name, depends, files, params, rng):
+    pkg_dir = os.path.join(repo, section, name)
+    os.makedirs(pkg_dir)
+    tarball = f"{name}-1.0.tar.gz"
+    make_tarball(os.path.join(dist, tarball), name, files, rng)
+    with open(os.path.join(dist, tarball), "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    with open(os.path.join(pkg_dir, "version"), "w") as f:
+        f.write(f"1.{rng.randint(0, 30)} 1\n")
+    with open(os.path.join(pkg_dir, "sources"), "w") as f:
+        f.write(f"{params['base_url']}/{tarball}\n")
+    with open(os.path.join(pkg_dir, "checksums"), "w") as f:
+        f.write(f"{digest} {tarball}\n")
+    with open(os.path.join(pkg_dir, "build"), "w") as f:
+        f.write(build_script(name, params["build_time"]))
+    if depends:
+        with open(os.path.join(pkg_dir, "depends"), "w") as f:
+            f.write("".join(f"{dep}\n" for dep in depends))
+
+def generate(workdir, **overrides):
+    params = dict(DEFAULTS, **overrides)
+    rng = random.Random(params["seed"])
+    repo = os.path.join(workdir, "repo")
+    dist = os.path.join(workdir, "dist")
+    shutil.rmtree(repo, ignore_errors=True)
+    shutil.rmtree(dist, ignore_errors=True)
+    os.makedirs(dist)
+
+    def add(name, depends, files=params["source_files"], section=None):
+        write_recipe(repo, dist, section or rng.choice(SECTIONS), name, depends, files, params, rng)
+
+    general = []
+    for i in range(params["packages"]):
+        name = f"{rng.choice(WORDS)}-{rng.choice(WORDS)}{i}"
+        depends = []
+        for dep in rng.sample(general, min(len(general), rng.randint(0, 3))):
+            depends.append(f"{dep} make" if rng.random() < 0.25 else dep)
+        add(name, depends)
+        general.append(name)
+    for i in range(params["depth"]):
+        add(f"deep-{i}", [f"deep-{i - 1}"] if i else [], files=1, section="core")
+    add("wide", general[:params["wide"]], files=1, section="core")
+    cluster = []
+    for i in range(params["cluster"]):
+        deps = rng.sample(cluster, min(len(cluster), rng.randint(0, 3)))
+        add(f"app-{i}", [f"{dep} make" if rng.random() < 0.25 else dep for dep in deps], section="extra")
+        cluster.append(f"app-{i}")
+    add("huge", [], files=params["huge_files"], section="extra")
+    add("app", cluster[-5:] + ["huge"], section="extra")
+
+    info = {
+        "params": params,
+        "repo": repo,
+        "dist": dist,
+        "packages": len(general) + params["depth"] + params["cluster"] + 3,
+        "deep": f"deep-{params['depth'] - 1}",
+        "wide": "wide",
+        "install": "app",
+        "huge": "huge",
+        "general": general,
+    }
+    with open(os.path.join(workdir, "repo.json"), "w") as f:
+        json.dump(info, f)
+    return info
+
+def load_or_generate(workdir, **overrides):
+    # Reuses an existing repository when it was generated with the same parameters
+    params = dict(DEFAULTS, **overrides)
+    try:
+        with open(os.path.join(workdir, "repo.json")) as f:
+            info = json.load(f)
+        if info["params"] == params:
+            return info
+    except (OSError, ValueError, KeyError):
+        pass
+    return generate(workdir, **overrides)
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic lxpkg repository")
+    parser.add_argument("workdir")
+    for key, value in DEFAULTS.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    args = vars(parser.parse_args())
+    workdir = args.pop("workdir")
+    info = generate(workdir, **args)
+    print(f"Generated {info['packages']} packages in {info['repo']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# Runs lxpkg subsystems against a generated repository inside an LXPKG_ROOT sandbox and prints JSON results.
+# Usage: python3 bench/run.py [--workdir DIR] [--repeat N] [--only NAME,...] [--output FILE] [--compare OLD.json]
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from genrepo import DEFAULTS, load_or_generate
+from server import SourceServer
+
+SEARCH_QUERIES = (["gcc"], ["ssl", "curl"], ["xz"], ["section:xorg", "mesa"], ["version:1.2", "lib"], ["app-1"])
+
+class Context:
+    def __init__(self, workdir, info):
+        self.workdir = workdir
+        self.info = info
+        self.repo = info["repo"]
+        self.root = os.path.join(workdir, "root")
+        self.cache = os.path.join(workdir, "cache")
+        self.tmp = os.path.join(workdir, "tmp")
+        self.sys_db = os.path.join(self.root, "var/db/lxpkg/installed")
+
+    def fresh(self, *names):
+        for name in names:
+            path = os.path.join(self.tmp, name)
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+        return [os.path.join(self.tmp, name) for name in names]
+
+def reset_state(ctx=None):
+    # lxpkg keeps per-process singletons; benchmarks that measure cold paths start from scratch
+    import src.index, src.search, src.fingerprint, src.db, src.fetch, src.trace
+    src.index._indexes.clear()
+    src.search._engines.clear()
+    src.fingerprint._build_keys.clear()
+    for db in src.db._dbs.values():
+        db.conn.close()
+    src.db._dbs.clear()
+    src.fetch._extracted.clear()
+    src.trace.reset()
+
+def install_closure(ctx):
+    from src.deps import Resolver
+    from src.pkg import Package
+    order = Resolver().resolve([ctx.info["install"]])
+    return [Package(name) for name in order]
+
+# Each benchmark is (setup, run); run returns the work done as {"items": ..., "bytes": ..., "files": ...}
+def setup_index_cold(ctx):
+    from src.index import index_path
+    reset_state()
+    for suffix in (".json", ".trigrams"):
+        path = index_path(ctx.repo)[:-len(".json")] + suffix
+        if os.path.exists(path):
+            os.unlink(path)
+
+def run_index(ctx):
+    from src.index import get_index
+    return {"items": len(get_index(ctx.repo).packages)}
+
+def run_lookup(ctx):
+    from src.pkg import Package
+    from src.index import get_index
+    names = list(get_index(ctx.repo).names())
+    for name in names:
+        Package(name).depends
+    return {"items": len(names)}
+
+def run_resolve(target):
+    def run(ctx):
+        from src.deps import Resolver
+        return {"items": len(Resolver().resolve([ctx.info[target]]))}
+    return run
+
+def run_resolve_all(ctx):
+    from src.deps import Resolver
+    return {"items": len(Resolver().resolve(ctx.info["general"]))}
+
+def setup_search_cold(ctx):
+    from src.index import index_path
+    reset_state()
+    path = index_path(ctx.repo)[:-len(".json")] + ".trigrams"
+    if os.path.exists(path):
+        os.unlink(path)
+
+def run_search(ctx):
+    from src.search import get_engine
+    results = 0
+    for query in SEARCH_QUERIES:
+        results += sum(1 for _ in get_engine(ctx.repo).search(query))
+    return {"items": results}
+
+def run_checksum(ctx):
+    from src.hashing import hash_files
+    paths = [os.path.join(ctx.info["dist"], name) for name in sorted(os.listdir(ctx.info["dist"]))]
+    hash_files(paths)
+    return {"items": len(paths), "bytes": sum(os.path.getsize(path) for path in paths)}
+
+def source_urls(ctx):
+    return [url for pkg in install_closure(ctx) for url in pkg.sources]
+
+def setup_download(ctx):
+    reset_state()
+    shutil.rmtree(os.path.join(ctx.cache, "sources"), ignore_errors=True)
+
+def run_download(ctx):
+    from src.cache import SourceCache
+    from src.download import get_downloader
+    cache = SourceCache()
+    downloader = get_downloader()
+    urls = source_urls(ctx)
+    futures = [downloader.submit(downloader.fetch, url, cache.tmp_path(str(i))) for i, url in enumerate(urls)]
+    for future in futures:
+        future.result()
+    nbytes = sum(os.path.getsize(cache.tmp_path(str(i))) for i in range(len(urls)))
+    return {"items": len(urls), "bytes": nbytes}
+
+def setup_extract(ctx):
+    from src.fetch import prefetch
+    reset_state()
+    for future in prefetch(install_closure(ctx)):
+        future.result()
+    ctx.fresh("src")
+
+def run_extract(ctx):
+    from src.fetch import fetch_sources
+    src_dir = os.path.join(ctx.tmp, "src")
+    pkgs = install_closure(ctx)
+    for pkg in pkgs:
+        fetch_sources(pkg, src_dir)
+    files = sum(len(files) for _, _, files in os.walk(src_dir))
+    return {"items": len(pkgs), "files": files}
+
+def setup_huge_tree(ctx):
+    # The huge package's source tree doubles as a package tree with a very large manifest
+    from src.pkg import Package
+    from src.fetch import fetch_sources
+    from src.build import write_manifest
+    reset_state()
+    src_dir, pkg_dir = ctx.fresh("src", "pkg")
+    pkg = Package(ctx.info["huge"])
+    fetch_sources(pkg, src_dir)
+    os.rename(os.path.join(src_dir, pkg.name), os.path.join(pkg_dir, pkg.name))
+    write_manifest(pkg, os.path.join(pkg_dir, pkg.name))
+    shutil.rmtree(ctx.root, ignore_errors=True)
+    os.makedirs(ctx.root)
+
+def run_manifest(ctx):
+    from src.pkg import Package
+    from src.build import write_manifest
+    pkg = Package(ctx.info["huge"])
+    with open(write_manifest(pkg, os.path.join(ctx.tmp, "pkg", pkg.name))) as f:
+        return {"files": sum(1 for _ in f)}
+
+def run_install(ctx):
+    from src.pkg import Package
+    from src.build import install_built_package
+    pkg = Package(ctx.info["huge"])
+    install_built_package(pkg, os.path.join(ctx.tmp, "pkg"), ctx.sys_db)
+    with open(os.path.join(ctx.sys_db, pkg.name, "manifest")) as f:
+        return {"files": sum(1 for _ in f)}
+
+def setup_reinstall(ctx):
+    # Installs over an identical copy, the best case for manifest diffing
+    setup_huge_tree(ctx)
+    run_install(ctx)
+
+def setup_e2e(keep_binaries):
+    def setup(ctx):
+        reset_state()
+        shutil.rmtree(ctx.root, ignore_errors=True)
+        os.makedirs(ctx.sys_db)
+        if not keep_binaries:
+            shutil.rmtree(os.path.join(ctx.cache, "bin"), ignore_errors=True)
+            shutil.rmtree(os.path.join(ctx.cache, "sources"), ignore_errors=True)
+        ctx.fresh("src", "build", "pkg")
+    return setup
+
+def run_e2e(ctx):
+    # The same steps as install_packages, with the sandbox's own temporary directories
+    from src.deps import Resolver
+    from src.db import open_db
+    from src.scheduler import Scheduler
+    from src.fingerprint import stale_packages
+    from src.binpkg import find_binary_package
+    targets = [ctx.info["install"]]
+    resolver = Resolver()
+    order = resolver.resolve(targets)
+    pkgs = [resolver.packages[name] for name in order]
+    stale = {pkg.name for pkg in stale_packages(pkgs, open_db(ctx.sys_db))}
+    prebuilt = {name for name in stale if find_binary_package(resolver.packages[name])}
+    needed = resolver.prune(targets, stale, prebuilt)
+    src_dir, bld_dir, pkg_dir = (os.path.join(ctx.tmp, name) for name in ("src", "build", "pkg"))
+    Scheduler([resolver.packages[name] for name in needed], src_dir, bld_dir, pkg_dir, ctx.sys_db).run()
+    return {"items": len(needed)}
+
+BENCHMARKS = {
+    "index-cold": (setup_index_cold, run_index),
+    "index-warm": (reset_state, run_index),
+    "lookup": (None, run_lookup),
+    "resolve-deep": (None, run_resolve("deep")),
+    "resolve-wide": (None, run_resolve("wide")),
+    "resolve-all": (None, run_resolve_all),
+    "search-cold": (setup_search_cold, run_search),
+    "search-warm": (None, run_search),
+    "checksum": (None, run_checksum),
+    "download": (setup_download, run_download),
+    "extract": (setup_extract, run_extract),
+    "manifest": (setup_huge_tree, run_manifest),
+    "install": (setup_huge_tree, run_install),
+    "reinstall": (setup_reinstall, run_install),
+    "e2e-build": (setup_e2e(False), run_e2e),
+    "e2e-binary": (setup_e2e(True), run_e2e),
+}
+
+def measure(ctx, name, repeat):
+    setup, run = BENCHMARKS[name]
+    times = []
+    work = {}
+    for _ in range(repeat):
+        if setup:
+            setup(ctx)
+        start = time.perf_counter()
+        work = run(ctx) or {}
+        times.append(time.perf_counter() - start)
+    result = {"median_s": statistics.median(times), "min_s": min(times), "runs": times}
+    result.update(work)
+    median = result["median_s"]
+    if median > 0:
+        for key in ("items", "files", "bytes"):
+            if key in work:
+                result[f"{key}_per_s"] = work[key] / median
+    return result
+
+def meta(params):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "machine": platform.machine(),
+            "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "params": params}
+
+def compare(old, new):
+    print(f"{'benchmark':<14} {'before':>10} {'after':>10} {'change':>8}", file=sys.stderr)
+    for name, result in new["results"].items():
+        before = old.get("results", {}).get(name)
+        if not before:
+            continue
+        change = (result["median_s"] / before["median_s"] - 1) * 100 if before["median_s"] else 0.0
+        print(f"{name:<14} {before['median_s'] * 1000:>8.1f}ms {result['median_s'] * 1000:>8.1f}ms {change:>+7.1f}%", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="lxpkg benchmarks")
+    parser.add_argument("--workdir", default="/tmp/lxpkg-bench")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", help="comma-separated benchmark names")
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    parser.add_argument("--compare", help="print the change against an earlier results file")
+    parser.add_argument("--port", type=int, default=8766)
+    for key, value in DEFAULTS.items():
+        if key != "base_url":
+            parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name} (choose from {', '.join(BENCHMARKS)})")
+    params = {key: getattr(args, key) for key in DEFAULTS if key != "base_url"}
+    params["base_url"] = f"http://127.0.0.1:{args.port}"
+
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    info = load_or_generate(workdir, **params)
+    ctx = Context(workdir, info)
+    # Everything lxpkg touches stays inside the work directory
+    os.environ.update(LXPKG_PATH=ctx.repo, LXPKG_CACHEDIR=ctx.cache, LXPKG_ROOT=ctx.root, LXPKG_COLOR="0",
+                      LXPKG_VERBOSE="0", LXPKG_TRACE="0")
+    os.makedirs(ctx.sys_db, exist_ok=True)
+    from src.utils import setup_logging
+    setup_logging(enabled=False)
+
+    results = {}
+    with SourceServer(info["dist"], args.port):
+        for name in names:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                results[name] = measure(ctx, name, args.repeat)
+            print(f"{name:<14} {results[name]['median_s'] * 1000:>10.1f} ms", file=sys.stderr)
+    output = {"meta": meta(params), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Local stand-in for upstream source mirrors: serves a directory over HTTP/1.1 with keep-alive and Range support.
+# Usage: python3 bench/server.py DIRECTORY [--port PORT]
+import os
+import re
+import sys
+import argparse
+import threading
+import http.server
+
+CHUNK_SIZE = 1 << 20
+
+class SourceHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    directory = "."
+
+    def do_GET(self):
+        path = os.path.join(self.directory, os.path.basename(self.path.split("?")[0]))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        st = os.stat(path)
+        size = st.st_size
+        etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+        start = 0
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range", etag) != etag:
+            # The client's partial copy is of something else: send the whole file
+            match = None
+        if match:
+            start = int(match.group(1))
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(size - start))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            while chunk := f.read(CHUNK_SIZE):
+                self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+class SourceServer:
+    def __init__(self, directory, port=0):
+        handler = type("Handler", (SourceHandler,), {"directory": os.path.abspath(directory)})
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve source tarballs for benchmarks")
+    parser.add_argument("directory")
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+    server = SourceServer(args.directory, args.port)
+    print(f"Serving {args.directory} at {server.url}", file=sys.stderr)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Measures lxpkg start-up: wall time of cheap commands against a bare interpreter, and where import time goes.
+# Usage: python3 bench/startup.py [-n RUNS] [--json] [command ...]
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run(argv, env):
+    start = time.perf_counter()
+    subprocess.run(argv, env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    return (time.perf_counter() - start) * 1000
+
+def wall_times(argv, env, runs):
+    run(argv, env)  # warm the page cache and __pycache__
+    return [run(argv, env) for _ in range(runs)]
+
+def import_times(command, env):
+    # Cumulative microseconds per top-level module, from -X importtime
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-m", "src.main"] + command, env=env, cwd=ROOT,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not name.startswith("  ") and cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative)
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser(description="lxpkg start-up benchmark")
+    parser.add_argument("-n", "--runs", type=int, default=20)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("commands", nargs="*", default=["v", "h", "l", "s"])
+    args = parser.parse_args()
+    env = dict(os.environ, PYTHONPATH=ROOT, LXPKG_COLOR="0")
+    results = {"python": sys.version.split()[0], "runs": args.runs, "commands": {}}
+    baseline = wall_times([sys.executable, "-c", "pass"], env, args.runs)
+    results["baseline_ms"] = statistics.median(baseline)
+    for command in args.commands:
+        times = wall_times([sys.executable, "-m", "src.main", command], env, args.runs)
+        imports = import_times([command], env)
+        results["commands"][command] = {
+            "median_ms": statistics.median(times),
+            "min_ms": min(times),
+            "overhead_ms": statistics.median(times) - results["baseline_ms"],
+            "import_ms": sum(imports.values()) / 1000,
+            "slowest_imports": sorted(imports.items(), key=lambda item: -item[1])[:5],
+        }
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print(f"python {results['python']}, {args.runs} runs, bare interpreter {results['baseline_ms']:.1f} ms")
+    print(f"{'command':<10} {'median':>9} {'min':>9} {'overhead':>9} {'imports':>9}  slowest imports")
+    for command, r in results["commands"].items():
+        slowest = ", ".join(f"{name} {us / 1000:.1f}" for name, us in r["slowest_imports"][:3])
+        print(f"{command:<10} {r['median_ms']:>7.1f}ms {r['min_ms']:>7.1f}ms {r['overhead_ms']:>7.1f}ms "
+              f"{r['import_ms']:>7.1f}ms  {slowest}")
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,13 @@
 import os
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 
 setup(
     name="lxpkg",
     version="1.2.7",
     packages=find_packages(),
     install_requires=["colorama"],
+    # Optional: src.hashing falls back to hashlib when the extension can't be built
+    ext_modules=[Extension("src.checksum", ["src/checksum.c"], libraries=["crypto"], optional=True)],
     entry_points={
         "console_scripts": [
             "lxpkg=src.main:main"
@@ -0,0 +1,76 @@
+import os
+import tarfile
+import subprocess
+from src.utils import log, warn
+from src.fingerprint import build_key
+
+COMPRESSORS = {
+    "gz": ("gz", None),
+    "xz": ("xz", None),
+    "zst": (None, ["zstd", "-q", "-T0"]),
+}
+
+def binary_dir():
+    return os.path.join(os.getenv("LXPKG_CACHEDIR", "/var/cache/lxpkg"), "bin")
+
+def compression():
+    comp = os.getenv("LXPKG_COMPRESS", "xz")
+    if comp not in COMPRESSORS:
+        warn(f"Unknown LXPKG_COMPRESS value '{comp}', using xz")
+        return "xz"
+    return comp
+
+def binary_name(pkg):
+    # The build key makes an edited recipe, or one of its dependencies, miss the cache even when
+    # version and release stay the same
+    return f"{pkg.name}-{pkg.version}-{pkg.release}-{build_key(pkg)[:16]}"
+
+def find_binary_package(pkg):
+    base = os.path.join(binary_dir(), binary_name(pkg))
+    preferred = compression()
+    for comp in [preferred] + [c for c in COMPRESSORS if c != preferred]:
+        path = f"{base}.tar.{comp}"
+        if os.path.exists(path):
+            return path
+    return None
+
+def create_binary_package(pkg, pkg_path):
+    comp = compression()
+    os.makedirs(binary_dir(), exist_ok=True)
+    path = os.path.join(binary_dir(), f"{binary_name(pkg)}.tar.{comp}")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    log(f"Creating binary package {os.path.basename(path)}")
+    mode, command = COMPRESSORS[comp]
+    try:
+        if command:
+            with open(tmp, "wb") as out:
+                proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=out)
+                with tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+                    tar.add(pkg_path, arcname=".")
+                proc.stdin.close()
+                if proc.wait() != 0:
+                    raise OSError(f"{command[0]} exited with status {proc.returncode}")
+        else:
+            with tarfile.open(tmp, f"w:{mode}") as tar:
+                tar.add(pkg_path, arcname=".")
+        os.replace(tmp, path)
+    except Exception as e:
+        warn(f"Failed to create binary package for {pkg.name}: {e}")
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        return None
+    return path
+
+def extract_binary_package(path, pkg_path):
+    log(f"Using binary package {os.path.basename(path)}")
+    os.makedirs(pkg_path, exist_ok=True)
+    if path.endswith(".zst"):
+        proc = subprocess.Popen(["zstd", "-q", "-d", "-c", path], stdout=subprocess.PIPE)
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+            tar.extractall(pkg_path, filter="fully_trusted")
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise OSError(f"zstd exited with status {proc.returncode}")
+    else:
+        with tarfile.open(path) as tar:
+            tar.extractall(pkg_path, filter="fully_trusted")
@@ -1,7 +1,18 @@
 import os
+import sys
 import subprocess
 import shutil
 from src.utils import log, warn, die, print_info, prompt
+from src.fetch import fetch_sources
+from src.install import install_files, remove_stale
+from src.manifest import Entry, UNKNOWN, scan_manifest, save_manifest, load_manifest, diff_manifests, file_paths, install_entries
+from src.stage import stage_mode, stage_sources
+from src.jobs import get_jobserver, package_jobs
+from src.fingerprint import metadata_dir, compute_fingerprint, dep_fingerprints
+from src.db import open_db
+from src.trace import span
+from src.binpkg import find_binary_package, create_binary_package, extract_binary_package
+from src.strip import strip_package
 
 def detect_build_system(build_dir):
     if os.path.exists(os.path.join(build_dir, "Cargo.toml")):
@@ -21,109 +32,192 @@ def detect_build_system(build_dir):
     return "custom"
 
 def build_package(pkg, src_dir, bld_dir, pkg_dir, sys_db):
+    prepare_package(pkg, src_dir, bld_dir, pkg_dir)
+    install_built_package(pkg, pkg_dir, sys_db)
+
+def prepare_package(pkg, src_dir, bld_dir, pkg_dir):
+    # Fill pkg_dir/<name> from a cached binary package, or compile it and cache the result
+    pkg_path = os.path.join(pkg_dir, pkg.name)
+    archive = find_binary_package(pkg)
+    if archive:
+        try:
+            with span("binpkg-extract", pkg=pkg.name, bytes=os.path.getsize(archive)):
+                extract_binary_package(archive, pkg_path)
+            return
+        except Exception as e:
+            warn(f"Failed to unpack binary package for {pkg.name}, rebuilding: {e}")
+            shutil.rmtree(pkg_path, ignore_errors=True)
+            fetch_sources(pkg, src_dir)
+    build_system = compile_package(pkg, src_dir, bld_dir, pkg_dir)
+    strip_package(pkg, pkg_path)
+    # Shipped with the package so installs from a binary package can fingerprint it too
+    os.makedirs(metadata_dir(pkg_path, pkg.name), exist_ok=True)
+    with open(os.path.join(metadata_dir(pkg_path, pkg.name), "build-system"), "w") as f:
+        f.write(f"{build_system}\n")
+    with span("manifest", pkg=pkg.name):
+        write_manifest(pkg, pkg_path)
+    with span("binpkg-create", pkg=pkg.name) as s:
+        archive = create_binary_package(pkg, pkg_path)
+        if archive:
+            s.add("bytes", os.path.getsize(archive))
+
+def write_manifest(pkg, pkg_path):
+    manifest_path = os.path.join(metadata_dir(pkg_path, pkg.name), "manifest")
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    rel_path = os.path.relpath(manifest_path, pkg_path)
+    entries = scan_manifest(pkg_path, exclude={rel_path, f"{rel_path}.tmp"})
+    # The manifest can't hash itself, so it is reinstalled every time
+    entries.append(Entry(rel_path, "f", 0o644, 0, 0, UNKNOWN))
+    entries.sort()
+    save_manifest(manifest_path, entries)
+    return manifest_path
+
+def compile_package(pkg, src_dir, bld_dir, pkg_dir):
     build_path = os.path.join(bld_dir, pkg.name)
     src_path = os.path.join(src_dir, pkg.name)
     pkg_path = os.path.join(pkg_dir, pkg.name)
-    os.makedirs(build_path, exist_ok=True)
     os.makedirs(pkg_path, exist_ok=True)
     
-    # Copy source files to build directory
-    log(f"Copying source files for {pkg.name} to {build_path}")
-    shutil.copytree(src_path, build_path, dirs_exist_ok=True)
-    
-    build_system = detect_build_system(build_path)
+    build_system = detect_build_system(src_path)
     log(f"Detected build system: {build_system} for {pkg.name}")
-    os.chdir(build_path)
+    with span("stage", pkg=pkg.name):
+        work_dir, out_dir = stage_sources(src_path, build_path, stage_mode(build_system))
+    
+    jobserver = get_jobserver()
+    jobs = package_jobs(pkg)
+    if jobs:
+        log(f"Using {jobs} jobs for {pkg.name} (set by recipe)")
+    
+    def run_ninja(args):
+        # Each build holds one token; ninja runs as many jobs as it can get more of at the start
+        extra = [] if jobs else jobserver.try_acquire(jobserver.slots - 1)
+        try:
+            run(["ninja"] + args + [f"-j{jobs or 1 + len(extra)}"])
+        finally:
+            for extra_token in extra:
+                jobserver.release(extra_token)
+    
+    def run(cmd, cwd=None, env=None):
+        run_env = jobserver.env(jobs)
+        run_env.update(env or {})
+        pass_fds = () if jobs else jobserver.pass_fds()
+        if sys.stdout is sys.__stdout__:
+            subprocess.run(cmd, cwd=cwd, env=run_env, pass_fds=pass_fds, check=True)
+            return
+        # Output is being captured (the daemon forwards it to its clients), so the build's has to go through it too
+        with subprocess.Popen(cmd, cwd=cwd, env=run_env, pass_fds=pass_fds, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, text=True, errors="replace") as proc:
+            for line in proc.stdout:
+                sys.stdout.write(line)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
     
     print_info(f"Building {pkg.name}...")
+    # The build holds one job slot itself; make and cargo take any further slots from the jobserver
+    with span("job-wait", pkg=pkg.name):
+        token = jobserver.acquire()
     try:
-        if build_system == "cargo":
-            subprocess.run(["cargo", "build", "--release"], check=True)
-            os.makedirs(os.path.join(pkg_path, "usr/bin"), exist_ok=True)
-            for f in os.listdir("target/release"):
-                if os.path.isfile(os.path.join("target/release", f)) and os.access(os.path.join("target/release", f), os.X_OK):
-                    shutil.copy(os.path.join("target/release", f), os.path.join(pkg_path, "usr/bin"))
-        elif build_system == "python":
-            if os.path.exists("setup.py"):
-                subprocess.run(["python3", "setup.py", "install", "--prefix=/usr", f"--root={pkg_path}"], check=True)
-            else:
+        with span("compile", pkg=pkg.name, build_system=build_system):
+            if build_system == "cargo":
+                # Without -j cargo takes its slots from the jobserver in CARGO_MAKEFLAGS
+                run(["cargo", "build", "--release"] + (["-j", str(jobs)] if jobs else []), cwd=work_dir, env={"CARGO_TARGET_DIR": out_dir})
+                release_dir = os.path.join(out_dir, "release")
                 os.makedirs(os.path.join(pkg_path, "usr/bin"), exist_ok=True)
-                for f in os.listdir("."):
-                    if os.path.isfile(f) and os.access(f, os.X_OK):
-                        shutil.copy(f, os.path.join(pkg_path, "usr/bin"))
-        elif build_system == "meson":
-            subprocess.run(["meson", "setup", "build", "--prefix=/usr"], check=True)
-            subprocess.run(["ninja", "-C", "build", "-j4"], check=True)
-            subprocess.run(["ninja", "-C", "build", "install", f"DESTDIR={pkg_path}"], check=True)
-        elif build_system == "cmake":
-            os.makedirs("build", exist_ok=True)
-            os.chdir("build")
-            subprocess.run(["cmake", "..", "-DCMAKE_INSTALL_PREFIX=/usr"], check=True)
-            subprocess.run(["make", "-j4"], check=True)
-            subprocess.run(["make", "install", f"DESTDIR={pkg_path}"], check=True)
-            os.chdir("..")
-        elif build_system == "autotools-autogen":
-            subprocess.run(["./autogen.sh"], check=True)
-            subprocess.run(["./configure", "--prefix=/usr"], check=True)
-            subprocess.run(["make", "-j4"], check=True)
-            subprocess.run(["make", "install", f"DESTDIR={pkg_path}"], check=True)
-        elif build_system == "autotools":
-            subprocess.run(["./configure", "--prefix=/usr"], check=True)
-            subprocess.run(["make", "-j4"], check=True)
-            subprocess.run(["make", "install", f"DESTDIR={pkg_path}"], check=True)
-        elif build_system == "make":
-            subprocess.run(["make", "-j4"], check=True)
-            subprocess.run(["make", "install", f"DESTDIR={pkg_path}"], check=True)
-        else:
-            build_script = os.path.join(pkg.dir, "build")
-            if os.path.exists(build_script):
-                log(f"Running custom build script for {pkg.name}")
-                subprocess.run(["sh", build_script, pkg_path], check=True)
+                for f in os.listdir(release_dir):
+                    if os.path.isfile(os.path.join(release_dir, f)) and os.access(os.path.join(release_dir, f), os.X_OK):
+                        shutil.copy(os.path.join(release_dir, f), os.path.join(pkg_path, "usr/bin"))
+            elif build_system == "python":
+                if os.path.exists(os.path.join(work_dir, "setup.py")):
+                    run(["python3", "setup.py", "install", "--prefix=/usr", f"--root={pkg_path}"], cwd=work_dir)
+                else:
+                    os.makedirs(os.path.join(pkg_path, "usr/bin"), exist_ok=True)
+                    for f in os.listdir(work_dir):
+                        f = os.path.join(work_dir, f)
+                        if os.path.isfile(f) and os.access(f, os.X_OK):
+                            shutil.copy(f, os.path.join(pkg_path, "usr/bin"))
+            elif build_system == "meson":
+                run(["meson", "setup", out_dir, "--prefix=/usr"], cwd=work_dir)
+                run_ninja(["-C", out_dir])
+                run(["ninja", "-C", out_dir, "install"], env={"DESTDIR": pkg_path})
+            elif build_system == "cmake":
+                run(["cmake", "-S", work_dir, "-B", out_dir, "-DCMAKE_INSTALL_PREFIX=/usr"])
+                run(["make"], cwd=out_dir)
+                run(["make", "install", f"DESTDIR={pkg_path}"], cwd=out_dir)
+            elif build_system == "autotools-autogen":
+                run(["./autogen.sh"], cwd=work_dir)
+                run(["./configure", "--prefix=/usr"], cwd=work_dir)
+                run(["make"], cwd=work_dir)
+                run(["make", "install", f"DESTDIR={pkg_path}"], cwd=work_dir)
+            elif build_system == "autotools":
+                run(["./configure", "--prefix=/usr"], cwd=work_dir)
+                run(["make"], cwd=work_dir)
+                run(["make", "install", f"DESTDIR={pkg_path}"], cwd=work_dir)
+            elif build_system == "make":
+                run(["make"], cwd=work_dir)
+                run(["make", "install", f"DESTDIR={pkg_path}"], cwd=work_dir)
             else:
-                die(f"Unsupported build system for {pkg.name}: {build_system}")
-        
-        # Install files
-        install_root = os.getenv("LXPKG_ROOT", "/")
-        manifest_path = os.path.join(pkg_path, "var/db/lxpkg/installed", pkg.name, "manifest")
-        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
-        with open(manifest_path, "w") as f:
-            for root, _, files in os.walk(pkg_path):
-                for file in files:
-                    rel_path = os.path.relpath(os.path.join(root, file), pkg_path)
-                    f.write(f"{rel_path}\n")
-        file_count = sum(1 for _ in open(manifest_path))
-        log(f"Installing {pkg.name} version {pkg.version}-{pkg.release} ({file_count} files)")
-        i = 0
-        dir_count = 0
-        file_count_actual = 0
-        with open(manifest_path) as f:
-            for line in f:
-                file = line.strip()
-                i += 1
-                percent = (i * 100) // file_count
-                print(f"\r==> Installing {pkg.name}: {percent:3d}% [{'#' * (percent // 5)}{' ' * (20 - percent // 5)}]", end="")
-                if file.endswith("/"):
-                    dir_count += 1
-                    os.makedirs(os.path.join(install_root, file), exist_ok=True)
+                build_script = os.path.join(pkg.dir, "build")
+                if os.path.exists(build_script):
+                    log(f"Running custom build script for {pkg.name}")
+                    run(["sh", build_script, pkg_path], cwd=work_dir)
                 else:
-                    src_file = os.path.join(pkg_path, file)
-                    dest_file = os.path.join(install_root, file)
-                    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
-                    if os.path.exists(src_file):
-                        shutil.copy(src_file, dest_file)
-                        file_count_actual += 1
-        print(f"\r==> Installed {pkg.name}: 100% [{'#' * 20}] ({file_count_actual} files, {dir_count} dirs)")
+                    die(f"Unsupported build system for {pkg.name}: {build_system}")
+    except Exception as e:
+        die(f"Build failed for {pkg.name}: {e}")
+    finally:
+        jobserver.release(token)
+    return build_system
+
+def install_built_package(pkg, pkg_dir, sys_db):
+    pkg_path = os.path.join(pkg_dir, pkg.name)
+    try:
+        db = open_db(sys_db)
+        install_root = os.getenv("LXPKG_ROOT", "/")
+        entries = load_manifest(os.path.join(metadata_dir(pkg_path, pkg.name), "manifest"))
+        if entries is None:
+            raise Exception("package has no manifest")
+        files = file_paths(entries)
+        # The installed version's manifest, read before the new one replaces it; packages installed
+        # before manifests existed only have their file list in the database
+        old = load_manifest(os.path.join(sys_db, pkg.name, "manifest"))
+        if old is None and db.get(pkg.name):
+            old = [Entry(path, UNKNOWN, None, None, None, UNKNOWN) for path in db.files(pkg.name)]
+        with span("conflicts", pkg=pkg.name, entries=len(files)):
+            conflicts = db.conflicts(pkg.name, files)
+        if conflicts:
+            for path, owner in conflicts[:10]:
+                warn(f"/{path} is owned by {owner}")
+            if len(conflicts) > 10:
+                warn(f"... and {len(conflicts) - 10} more")
+            if not prompt(f"{pkg.name} would overwrite {len(conflicts)} files owned by other packages. Continue?"):
+                raise Exception("file conflicts")
+        changed, unchanged, stale, retyped = diff_manifests(old, entries, install_root)
+        # Paths another package has taken over since are left to it
+        stale = [entry for entry in stale if db.owner(entry.path) in (None, pkg.name)]
+        retyped = [entry for entry in retyped if db.owner(entry.path) in (None, pkg.name)]
+        if retyped:
+            replaced = {entry.path for entry in retyped}
+            remove_stale(pkg.name, install_root, retyped, [path for path in files if path not in replaced])
+        log(f"Installing {pkg.name} version {pkg.version}-{pkg.release} ({len(files)} files, {len(unchanged)} unchanged)")
+        install_files(pkg.name, pkg_path, install_root, install_entries(changed))
+        if unchanged:
+            # Identical files from a new build keep their contents but take its mtime, which the next upgrade checks
+            installed_mtimes = {entry.path: entry.mtime for entry in old}
+            for entry in unchanged:
+                if entry.type == "f" and installed_mtimes.get(entry.path) != entry.mtime:
+                    os.utime(os.path.join(install_root, entry.path), (entry.mtime, entry.mtime))
+        remove_stale(pkg.name, install_root, stale, files)
         
         # Record in system database
-        sys_db_pkg = os.path.join(sys_db, pkg.name)
-        os.makedirs(sys_db_pkg, exist_ok=True)
-        with open(os.path.join(sys_db_pkg, "version"), "w") as f:
-            f.write(f"{pkg.version} {pkg.release}\n")
-        if pkg.depends:
-            with open(os.path.join(sys_db_pkg, "depends"), "w") as f:
-                f.write("\n".join(pkg.depends) + "\n")
-        shutil.copy(manifest_path, sys_db_pkg)
+        try:
+            with open(os.path.join(metadata_dir(pkg_path, pkg.name), "build-system")) as f:
+                build_system = f.read().strip()
+        except FileNotFoundError:
+            build_system = "unknown"
+        fingerprint = compute_fingerprint(pkg, build_system, dep_fingerprints(pkg, db))
+        with span("record", pkg=pkg.name):
+            db.record_install(pkg.name, pkg.version, pkg.release, pkg.depends, files, fingerprint, build_system)
         
         log(f"Successfully installed {pkg.name} version {pkg.version}-{pkg.release}")
     except Exception as e:
-        die(f"Build failed for {pkg.name}: {e}")
+        die(f"Install failed for {pkg.name}: {e}")
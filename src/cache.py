@@ -0,0 +1,147 @@
+import os
+import fcntl
+import hashlib
+import logging
+from contextlib import contextmanager
+
+SIZE_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+def parse_size(value):
+    value = str(value).strip().upper().rstrip("B")
+    if value and value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+def url_key(url):
+    return hashlib.sha1(url.encode()).hexdigest()
+
+class SourceCache:
+    # Layout under LXPKG_CACHEDIR/sources:
+    #   sha256/<digest>  source files, addressed by content
+    #   names/<url key>  digest of the last file fetched from a URL (for sources without checksums)
+    #   locks/<key>      flock files serializing fetches of the same source across processes
+    #   tmp/             partial downloads
+    def __init__(self, root=None, max_size=None):
+        cache_dir = os.getenv("LXPKG_CACHEDIR", "/var/cache/lxpkg")
+        self.root = root or os.path.join(cache_dir, "sources")
+        self.max_size = parse_size(max_size or os.getenv("LXPKG_CACHE_SIZE") or "10G")
+        for sub in ("sha256", "names", "locks", "tmp"):
+            os.makedirs(os.path.join(self.root, sub), exist_ok=True)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, "sha256", digest)
+
+    def tmp_path(self, key):
+        return os.path.join(self.root, "tmp", f"{key}.part")
+
+    def _digest(self, checksum, url):
+        if checksum is None and url is not None:
+            try:
+                with open(os.path.join(self.root, "names", url_key(url))) as f:
+                    return f.read().strip()
+            except FileNotFoundError:
+                return None
+        return checksum
+
+    def _touch(self, digest):
+        path = self.blob_path(digest)
+        try:
+            # mtime doubles as the LRU timestamp
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def lookup(self, checksum=None, url=None):
+        # Only says whether a source is cached; reading it goes through use(), which keeps it from being evicted
+        digest = self._digest(checksum, url)
+        return self._touch(digest) if digest else None
+
+    @contextmanager
+    def use(self, checksum=None, url=None):
+        # Yields the cached path, or None, with the blob locked against eviction until the block ends
+        digest = self._digest(checksum, url)
+        if not digest:
+            yield None
+            return
+        with self.lock(f"blob-{digest}", shared=True):
+            yield self._touch(digest)
+
+    def store(self, tmp_path, digest, url=None):
+        path = self.blob_path(digest)
+        os.replace(tmp_path, path)
+        if url is not None:
+            name_file = os.path.join(self.root, "names", url_key(url))
+            with open(f"{name_file}.{os.getpid()}.tmp", "w") as f:
+                f.write(f"{digest}\n")
+            os.replace(f"{name_file}.{os.getpid()}.tmp", name_file)
+        self.evict(keep=path)
+        return path
+
+    @contextmanager
+    def lock(self, key, shared=False, blocking=True):
+        # Yields False instead of waiting when blocking is off and the lock is taken
+        path = os.path.join(self.root, "locks", key)
+        while True:
+            f = open(path, "a")
+            try:
+                fcntl.flock(f, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                f.close()
+                yield False
+                return
+            # Eviction unlinks lock files while holding them; a lock taken on a file that is gone guards nothing
+            try:
+                if os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+        with f:
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _unlink_lock(self, key):
+        # Only called with the lock held exclusively, so nobody can be relying on the file
+        try:
+            os.unlink(os.path.join(self.root, "locks", key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self, keep=None):
+        with self.lock("evict"):
+            blobs = []
+            total = 0
+            with os.scandir(os.path.join(self.root, "sha256")) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    blobs.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+            if total <= self.max_size:
+                return
+            # Least recently used first, skipping blobs another process or thread is reading
+            for _, size, path in sorted(blobs):
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                digest = os.path.basename(path)
+                with self.lock(f"blob-{digest}", blocking=False) as locked:
+                    if not locked:
+                        continue
+                    try:
+                        os.unlink(path)
+                        total -= size
+                        logging.debug(f"Evicted {path} from source cache ({size} bytes)")
+                    except FileNotFoundError:
+                        pass
+                    self._unlink_lock(f"blob-{digest}")
+                # The fetch lock of a checksummed source is keyed on its digest too
+                with self.lock(digest, blocking=False) as locked:
+                    if locked:
+                        self._unlink_lock(digest)
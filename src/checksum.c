@@ -1,31 +1,339 @@
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
-#include <openssl/sha.h>
+#include <openssl/evp.h>
 #include <string.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <pthread.h>
 
-static PyObject* sha256sum(PyObject* self, PyObject* args) {
+#define READ_SIZE (1 << 20)
+#define GIL_THRESHOLD (64 * 1024)
+#define MAX_THREADS 64
+
+static void to_hex(const unsigned char *hash, unsigned int len, char *hex) {
+    static const char digits[] = "0123456789abcdef";
+    for (unsigned int i = 0; i < len; i++) {
+        hex[i * 2] = digits[hash[i] >> 4];
+        hex[i * 2 + 1] = digits[hash[i] & 0xf];
+    }
+    hex[len * 2] = 0;
+}
+
+/* Hashes an open file with a large read buffer; returns 0 or an errno value. Called without the GIL. */
+static int hash_fd(int fd, unsigned char *buf, char *hex) {
+    unsigned char hash[EVP_MAX_MD_SIZE];
+    unsigned int len = 0;
+    EVP_MD_CTX *ctx = EVP_MD_CTX_new();
+    if (ctx == NULL || !EVP_DigestInit_ex(ctx, EVP_sha256(), NULL)) {
+        EVP_MD_CTX_free(ctx);
+        return ENOMEM;
+    }
+    for (;;) {
+        ssize_t n = read(fd, buf, READ_SIZE);
+        if (n < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            int err = errno;
+            EVP_MD_CTX_free(ctx);
+            return err;
+        }
+        if (n == 0) {
+            break;
+        }
+        EVP_DigestUpdate(ctx, buf, n);
+    }
+    EVP_DigestFinal_ex(ctx, hash, &len);
+    EVP_MD_CTX_free(ctx);
+    to_hex(hash, len, hex);
+    return 0;
+}
+
+static int hash_path(const char *path, unsigned char *buf, char *hex) {
+    int fd = open(path, O_RDONLY | O_CLOEXEC);
+    if (fd < 0) {
+        return errno;
+    }
+#ifdef POSIX_FADV_SEQUENTIAL
+    posix_fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL);
+#endif
+    int err = hash_fd(fd, buf, hex);
+    close(fd);
+    return err;
+}
+
+/* Incremental hasher */
+
+typedef struct {
+    PyObject_HEAD
+    EVP_MD_CTX *ctx;
+    PyThread_type_lock lock;
+} HasherObject;
+
+/* The context and lock are set up here rather than in __init__, so a Hasher is usable however it was created */
+static PyObject *Hasher_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    HasherObject *self = (HasherObject *)type->tp_alloc(type, 0);
+    if (self == NULL) {
+        return NULL;
+    }
+    self->ctx = EVP_MD_CTX_new();
+    self->lock = PyThread_allocate_lock();
+    if (self->ctx == NULL || self->lock == NULL || !EVP_DigestInit_ex(self->ctx, EVP_sha256(), NULL)) {
+        Py_DECREF(self);
+        return PyErr_NoMemory();
+    }
+    return (PyObject *)self;
+}
+
+static int Hasher_init(HasherObject *self, PyObject *args, PyObject *kwds) {
+    Py_buffer buffer = {0};
+    if (!PyArg_ParseTuple(args, "|y*", &buffer)) {
+        return -1;
+    }
+    if (!EVP_DigestInit_ex(self->ctx, EVP_sha256(), NULL)) {
+        PyBuffer_Release(&buffer);
+        PyErr_NoMemory();
+        return -1;
+    }
+    if (buffer.buf != NULL) {
+        EVP_DigestUpdate(self->ctx, buffer.buf, buffer.len);
+        PyBuffer_Release(&buffer);
+    }
+    return 0;
+}
+
+static void Hasher_dealloc(HasherObject *self) {
+    EVP_MD_CTX_free(self->ctx);
+    if (self->lock != NULL) {
+        PyThread_free_lock(self->lock);
+    }
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *Hasher_update(HasherObject *self, PyObject *args) {
     Py_buffer buffer;
     if (!PyArg_ParseTuple(args, "y*", &buffer)) {
         return NULL;
     }
+    if (buffer.len >= GIL_THRESHOLD) {
+        /* The per-object lock keeps concurrent updates from other threads ordered */
+        Py_BEGIN_ALLOW_THREADS
+        PyThread_acquire_lock(self->lock, 1);
+        EVP_DigestUpdate(self->ctx, buffer.buf, buffer.len);
+        PyThread_release_lock(self->lock);
+        Py_END_ALLOW_THREADS
+    } else {
+        PyThread_acquire_lock(self->lock, 1);
+        EVP_DigestUpdate(self->ctx, buffer.buf, buffer.len);
+        PyThread_release_lock(self->lock);
+    }
+    PyBuffer_Release(&buffer);
+    Py_RETURN_NONE;
+}
 
-    unsigned char hash[SHA256_DIGEST_LENGTH];
-    SHA256_CTX sha256;
-    SHA256_Init(&sha256);
-    SHA256_Update(&sha256, buffer.buf, buffer.len);
-    SHA256_Final(hash, &sha256);
+static PyObject *Hasher_hexdigest(HasherObject *self, PyObject *Py_UNUSED(ignored)) {
+    unsigned char hash[EVP_MAX_MD_SIZE];
+    unsigned int len = 0;
+    char hex[EVP_MAX_MD_SIZE * 2 + 1];
+    /* Finalize a copy so the hasher can keep accepting data */
+    EVP_MD_CTX *copy = EVP_MD_CTX_new();
+    if (copy == NULL) {
+        return PyErr_NoMemory();
+    }
+    PyThread_acquire_lock(self->lock, 1);
+    EVP_MD_CTX_copy_ex(copy, self->ctx);
+    PyThread_release_lock(self->lock);
+    EVP_DigestFinal_ex(copy, hash, &len);
+    EVP_MD_CTX_free(copy);
+    to_hex(hash, len, hex);
+    return PyUnicode_FromString(hex);
+}
+
+static PyMethodDef Hasher_methods[] = {
+    {"update", (PyCFunction)Hasher_update, METH_VARARGS, "Feed bytes into the hash"},
+    {"hexdigest", (PyCFunction)Hasher_hexdigest, METH_NOARGS, "Return the SHA256 of the data so far as hex"},
+    {NULL, NULL, 0, NULL}
+};
 
-    char hex[65];
-    for (int i = 0; i < SHA256_DIGEST_LENGTH; i++) {
-        sprintf(hex + (i * 2), "%02x", hash[i]);
+static PyTypeObject HasherType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "checksum.Hasher",
+    .tp_doc = "Incremental SHA256 hasher",
+    .tp_basicsize = sizeof(HasherObject),
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_new = Hasher_new,
+    .tp_init = (initproc)Hasher_init,
+    .tp_dealloc = (destructor)Hasher_dealloc,
+    .tp_methods = Hasher_methods,
+};
+
+/* Module functions */
+
+static PyObject *sha256sum(PyObject *self, PyObject *args) {
+    Py_buffer buffer;
+    if (!PyArg_ParseTuple(args, "y*", &buffer)) {
+        return NULL;
     }
-    hex[64] = 0;
 
+    unsigned char hash[EVP_MAX_MD_SIZE];
+    unsigned int len = 0;
+    char hex[EVP_MAX_MD_SIZE * 2 + 1];
+    int ok;
+    Py_BEGIN_ALLOW_THREADS
+    ok = EVP_Digest(buffer.buf, buffer.len, hash, &len, EVP_sha256(), NULL);
+    Py_END_ALLOW_THREADS
     PyBuffer_Release(&buffer);
-    return Py_BuildValue("s", hex);
+    if (!ok) {
+        return PyErr_NoMemory();
+    }
+    to_hex(hash, len, hex);
+    return PyUnicode_FromString(hex);
+}
+
+static PyObject *hash_file(PyObject *self, PyObject *args) {
+    PyObject *arg, *path;
+    if (!PyArg_ParseTuple(args, "O", &arg) || !PyUnicode_FSConverter(arg, &path)) {
+        return NULL;
+    }
+    unsigned char *buf = PyMem_RawMalloc(READ_SIZE);
+    if (buf == NULL) {
+        Py_DECREF(path);
+        return PyErr_NoMemory();
+    }
+    char hex[EVP_MAX_MD_SIZE * 2 + 1];
+    int err;
+    Py_BEGIN_ALLOW_THREADS
+    err = hash_path(PyBytes_AS_STRING(path), buf, hex);
+    Py_END_ALLOW_THREADS
+    PyMem_RawFree(buf);
+    if (err) {
+        errno = err;
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, arg);
+        Py_DECREF(path);
+        return NULL;
+    }
+    Py_DECREF(path);
+    return PyUnicode_FromString(hex);
+}
+
+typedef struct {
+    const char **paths;
+    char (*hexes)[EVP_MAX_MD_SIZE * 2 + 1];
+    int *errors;
+    Py_ssize_t count;
+    Py_ssize_t next;
+    pthread_mutex_t mutex;
+} HashJob;
+
+static void *hash_worker(void *arg) {
+    HashJob *job = arg;
+    unsigned char *buf = malloc(READ_SIZE);
+    for (;;) {
+        pthread_mutex_lock(&job->mutex);
+        Py_ssize_t i = job->next++;
+        pthread_mutex_unlock(&job->mutex);
+        if (i >= job->count) {
+            break;
+        }
+        job->errors[i] = buf ? hash_path(job->paths[i], buf, job->hexes[i]) : ENOMEM;
+    }
+    free(buf);
+    return NULL;
+}
+
+static PyObject *hash_files(PyObject *self, PyObject *args) {
+    PyObject *iterable;
+    int threads = 0;
+    if (!PyArg_ParseTuple(args, "O|i", &iterable, &threads)) {
+        return NULL;
+    }
+    PyObject *seq = PySequence_Fast(iterable, "hash_files expects a sequence of paths");
+    if (seq == NULL) {
+        return NULL;
+    }
+    Py_ssize_t count = PySequence_Fast_GET_SIZE(seq);
+    PyObject *encoded = PyList_New(count);
+    HashJob job = {0};
+    PyObject *result = NULL;
+    pthread_t tids[MAX_THREADS];
+    if (encoded == NULL) {
+        goto done;
+    }
+    job.paths = PyMem_Calloc(count ? count : 1, sizeof(char *));
+    job.hexes = PyMem_Calloc(count ? count : 1, sizeof(*job.hexes));
+    job.errors = PyMem_Calloc(count ? count : 1, sizeof(int));
+    if (job.paths == NULL || job.hexes == NULL || job.errors == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    for (Py_ssize_t i = 0; i < count; i++) {
+        PyObject *path;
+        if (!PyUnicode_FSConverter(PySequence_Fast_GET_ITEM(seq, i), &path)) {
+            goto done;
+        }
+        PyList_SET_ITEM(encoded, i, path);
+        job.paths[i] = PyBytes_AS_STRING(path);
+    }
+    job.count = count;
+    pthread_mutex_init(&job.mutex, NULL);
+    if (threads <= 0) {
+        long cpus = sysconf(_SC_NPROCESSORS_ONLN);
+        threads = cpus > 0 ? (int)cpus : 1;
+    }
+    if (threads > MAX_THREADS) {
+        threads = MAX_THREADS;
+    }
+    if (threads > count) {
+        threads = count ? (int)count : 1;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    int started = 0;
+    for (int t = 0; t < threads; t++) {
+        if (pthread_create(&tids[t], NULL, hash_worker, &job) == 0) {
+            started++;
+        }
+    }
+    if (started == 0) {
+        hash_worker(&job);
+    }
+    for (int t = 0; t < started; t++) {
+        pthread_join(tids[t], NULL);
+    }
+    Py_END_ALLOW_THREADS
+    pthread_mutex_destroy(&job.mutex);
+    for (Py_ssize_t i = 0; i < count; i++) {
+        if (job.errors[i]) {
+            errno = job.errors[i];
+            PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, PySequence_Fast_GET_ITEM(seq, i));
+            goto done;
+        }
+    }
+    result = PyList_New(count);
+    if (result == NULL) {
+        goto done;
+    }
+    for (Py_ssize_t i = 0; i < count; i++) {
+        PyObject *hex = PyUnicode_FromString(job.hexes[i]);
+        if (hex == NULL) {
+            Py_CLEAR(result);
+            goto done;
+        }
+        PyList_SET_ITEM(result, i, hex);
+    }
+done:
+    PyMem_Free(job.paths);
+    PyMem_Free(job.hexes);
+    PyMem_Free(job.errors);
+    Py_XDECREF(encoded);
+    Py_DECREF(seq);
+    return result;
 }
 
 static PyMethodDef ChecksumMethods[] = {
     {"sha256sum", sha256sum, METH_VARARGS, "Compute SHA256 checksum of a buffer"},
+    {"hash_file", hash_file, METH_VARARGS, "Compute SHA256 checksum of a file"},
+    {"hash_files", hash_files, METH_VARARGS, "Compute SHA256 checksums of many files in parallel threads"},
     {NULL, NULL, 0, NULL}
 };
 
@@ -38,5 +346,18 @@ static struct PyModuleDef checksummodule = {
 };
 
 PyMODINIT_FUNC PyInit_checksum(void) {
-    return PyModule_Create(&checksummodule);
+    if (PyType_Ready(&HasherType) < 0) {
+        return NULL;
+    }
+    PyObject *module = PyModule_Create(&checksummodule);
+    if (module == NULL) {
+        return NULL;
+    }
+    Py_INCREF(&HasherType);
+    if (PyModule_AddObject(module, "Hasher", (PyObject *)&HasherType) < 0) {
+        Py_DECREF(&HasherType);
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
 }
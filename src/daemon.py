@@ -0,0 +1,429 @@
+import os
+import sys
+import json
+import queue
+import socket
+import threading
+from src.utils import log, warn, die, print_success
+
+# Installs from many clients go through one coordinator: requests that arrive while nothing runs are merged into
+# a single batch, requests covered by the running batch just wait for their packages, the rest queue for the next one
+
+_context = threading.local()
+
+# Events waiting for a client that has stopped reading; past this it is dropped instead of holding up the builds
+QUEUE_EVENTS = 4096
+# Settings an install through the daemon has to share with the client. Everything LXPKG_ counts except the
+# ones that only affect the client itself
+CLIENT_ENV = ("LXPKG_SOCKET", "LXPKG_DAEMON", "LXPKG_COLOR", "LXPKG_VERBOSE", "LXPKG_SUDO", "LXPKG_SU")
+BUILD_ENV = ("CC", "CXX", "CPP", "CFLAGS", "CXXFLAGS", "CPPFLAGS", "LDFLAGS", "RUSTFLAGS", "MAKEFLAGS", "STRIP")
+
+def install_env(environ=None):
+    environ = os.environ if environ is None else environ
+    return {key: value for key, value in environ.items()
+            if key in BUILD_ENV or (key.startswith("LXPKG_") and key not in CLIENT_ENV)}
+
+def socket_path():
+    return os.getenv("LXPKG_SOCKET", "/run/lxpkg.sock")
+
+def connect():
+    path = socket_path()
+    if os.getenv("LXPKG_DAEMON", "1") != "1" or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+def request(sock, message):
+    # Sends one request and yields the events the daemon streams back, up to and including "done"
+    sock.sendall(json.dumps(message).encode() + b"\n")
+    with sock.makefile("r", encoding="utf-8") as f:
+        for line in f:
+            event = json.loads(line)
+            yield event
+            if event["event"] == "done":
+                return
+
+def client_install(pkg_names):
+    # Returns False when no daemon is running, or when it runs with different settings, so the caller
+    # installs by itself
+    sock = connect()
+    if sock is None:
+        return False
+    with sock:
+        for event in request(sock, {"command": "install", "packages": pkg_names, "env": install_env()}):
+            if event["event"] == "output":
+                print(event["text"], flush=True)
+            elif event["event"] == "done":
+                if event.get("mismatch"):
+                    log(f"The lxpkg daemon runs with different {', '.join(event['mismatch'])}; installing directly")
+                    return False
+                if not event["ok"]:
+                    die(event["message"])
+                print_success(event["message"])
+                return True
+    die("The lxpkg daemon closed the connection")
+
+class Job:
+    # One install request: its targets, everything they depend on, and the client to report to. Events are
+    # queued and written by a thread of their own, so a slow client never blocks a build or the daemon's lock
+    def __init__(self, targets, closure, send, drop=None):
+        self.targets = targets
+        self.closure = set(closure)
+        self.remaining = set()
+        self.finished = threading.Event()
+        self.ok = False
+        self.message = None
+        self.events = queue.Queue(QUEUE_EVENTS)
+        self._drop = drop
+        self.writer = None
+        if send:
+            self.writer = threading.Thread(target=self._write, args=(send,), name="lxpkg-client", daemon=True)
+            self.writer.start()
+
+    def _write(self, send):
+        while (event := self.events.get()) is not None:
+            try:
+                send(event)
+            except OSError:
+                # The client went away; the packages are still built for everyone else
+                return
+
+    def send(self, event):
+        if self.writer is None:
+            return
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.writer = None
+            if self._drop:
+                self._drop()
+            warn(f"Dropped a client of {', '.join(self.targets)} that stopped reading")
+
+    def close(self):
+        # Waits until everything queued has been written, or the client is gone
+        writer = self.writer
+        while writer and writer.is_alive():
+            try:
+                self.events.put(None, timeout=1)
+                break
+            except queue.Full:
+                pass
+        if writer:
+            writer.join()
+
+    def finish(self, ok, message=None):
+        if not self.finished.is_set():
+            self.ok = ok
+            self.message = message
+            self.finished.set()
+
+class Batch:
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.order = None
+        self.needed = set()
+        self.installed = set()
+        self.broken = set()
+        self.failed = False
+
+    def targets(self):
+        targets = []
+        for job in self.jobs:
+            targets += [name for name in job.targets if name not in targets]
+        return targets
+
+    def adopt(self, job):
+        # A request whose whole dependency closure is already part of this batch needs no run of its own
+        if self.order is None or self.failed or not job.closure <= self.order:
+            return False
+        job.remaining = (job.closure & self.needed) - self.installed
+        self.jobs.append(job)
+        if not job.remaining:
+            job.finish(True)
+        return True
+
+    def package_done(self, name):
+        self.installed.add(name)
+        for job in self.jobs:
+            if name in job.remaining:
+                job.remaining.discard(name)
+                job.send({"event": "installed", "package": name})
+                if not job.remaining:
+                    job.finish(True)
+
+    def output(self, package, line):
+        for job in self.jobs:
+            if not job.finished.is_set() and (package is None or package in job.closure):
+                job.send({"event": "output", "text": line})
+
+def _make_scheduler(batch):
+    from src.scheduler import Scheduler
+
+    class DaemonScheduler(Scheduler):
+        # Tags output with the package it belongs to and reports each finished package to its clients
+        def _build(self, name):
+            _context.package = name
+            try:
+                super()._build(name)
+            except BaseException:
+                batch.broken.add(name)
+                raise
+            finally:
+                _context.package = None
+            with Daemon.lock:
+                batch.package_done(name)
+            return name
+
+        def _fetch(self, name):
+            _context.package = name
+            try:
+                return super()._fetch(name)
+            except BaseException:
+                batch.broken.add(name)
+                raise
+            finally:
+                _context.package = None
+
+    return DaemonScheduler
+
+class _Output:
+    # Stands in for sys.stdout: everything still goes to the daemon's own output, and each complete line is
+    # also sent to the clients interested in it
+    def __init__(self, daemon, stream):
+        self.daemon = daemon
+        self.stream = stream
+
+    def write(self, text):
+        self.stream.write(text)
+        lines = (getattr(_context, "buffer", "") + text).split("\n")
+        _context.buffer = lines.pop()
+        for line in lines:
+            # Progress bars redraw with \r; only their final state is worth sending
+            self.daemon.output(line.rsplit("\r", 1)[-1])
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self):
+        return False
+
+    def fileno(self):
+        return self.stream.fileno()
+
+class Daemon:
+    lock = threading.Condition()
+
+    def __init__(self):
+        self.queue = []
+        self.batch = None
+        self.running = True
+
+    def output(self, line):
+        job = getattr(_context, "job", None)
+        if job is not None:
+            job.send({"event": "output", "text": line})
+            return
+        with Daemon.lock:
+            if self.batch:
+                self.batch.output(getattr(_context, "package", None), line)
+
+    def submit(self, job):
+        with Daemon.lock:
+            if self.batch and self.batch.adopt(job):
+                job.send({"event": "output", "text": f"Joined the running install of {', '.join(sorted(self.batch.targets()))}"})
+                return
+            self.queue.append(job)
+            Daemon.lock.notify_all()
+
+    def status(self):
+        with Daemon.lock:
+            return {"queued": [job.targets for job in self.queue],
+                    "running": self.batch.targets() if self.batch else [],
+                    "installed": sorted(self.batch.installed) if self.batch else []}
+
+    def coordinate(self):
+        while True:
+            with Daemon.lock:
+                while self.running and not self.queue:
+                    Daemon.lock.wait()
+                if not self.running:
+                    for job in self.queue:
+                        job.finish(False, "The lxpkg daemon stopped")
+                    return
+                self.batch = Batch(self.queue)
+                self.queue = []
+            try:
+                self.run_batch(self.batch)
+            finally:
+                with Daemon.lock:
+                    self.batch = None
+
+    def run_batch(self, batch):
+        from src.main import setup_temp_dirs, cleanup_temp_dirs, plan_install
+        from src.index import get_index
+        from src.db import install_lock
+        from src.fingerprint import reset_build_keys
+        from src.trace import report, reset
+        targets = batch.targets()
+        work_dir = None
+        success = False
+        try:
+            # Warm state is only trusted as far as it is cheap to recheck: new recipes are picked up
+            # by refreshing the index, edited ones by recomputing build keys
+            get_index(os.getenv("LXPKG_PATH", "/usr/src/lxpkg/repo")).refresh()
+            reset_build_keys()
+            work_dir, cache_dir, src_dir, bld_dir, pkg_dir, sys_db = setup_temp_dirs()
+            with install_lock(sys_db):
+                resolver, needed = plan_install(targets, sys_db)
+                with Daemon.lock:
+                    batch.order = set(resolver.order)
+                    batch.needed = set(needed)
+                    for job in batch.jobs:
+                        job.remaining = job.closure & batch.needed
+                        if not job.remaining:
+                            job.finish(True)
+                if needed:
+                    scheduler = _make_scheduler(batch)
+                    scheduler([resolver.packages[name] for name in needed], src_dir, bld_dir, pkg_dir, sys_db).run()
+            success = True
+        except (Exception, SystemExit) as e:
+            message = str(e) if isinstance(e, Exception) else f"{', '.join(sorted(batch.broken)) or 'build'} failed"
+            warn(f"Install of {', '.join(targets)} failed: {message}")
+            with Daemon.lock:
+                batch.failed = True
+                for job in batch.jobs:
+                    if job.finished.is_set():
+                        continue
+                    if batch.broken and not job.closure & batch.broken:
+                        # Merged with a request that failed on packages this one doesn't need: try again on its own
+                        job.send({"event": "output", "text": f"Retrying {', '.join(job.targets)} without {', '.join(sorted(batch.broken))}"})
+                        self.queue.append(job)
+                    else:
+                        job.finish(False, f"Installation failed for {', '.join(job.targets)}: {message}")
+        finally:
+            if success:
+                with Daemon.lock:
+                    for job in batch.jobs:
+                        job.finish(True)
+            if work_dir:
+                cleanup_temp_dirs(work_dir, success)
+            report()
+            reset()
+
+    def handle(self, message, send, drop=None):
+        command = message.get("command")
+        if command == "ping":
+            send({"event": "done", "ok": True})
+        elif command == "status":
+            send(dict(self.status(), event="done", ok=True))
+        elif command == "stop":
+            send({"event": "done", "ok": True})
+            self.stop()
+        elif command == "install":
+            self.install(message.get("packages") or [], message.get("env") or {}, send, drop)
+        else:
+            send({"event": "done", "ok": False, "message": f"Unknown command: {command}"})
+
+    def install(self, targets, env, send, drop):
+        from src.deps import Resolver
+        from src.index import get_index
+        ours = install_env()
+        mismatch = sorted(key for key in set(env) | set(ours) if env.get(key) != ours.get(key))
+        if mismatch:
+            send({"event": "done", "ok": False, "mismatch": mismatch, "message": "different settings"})
+            return
+        job = Job(targets, (), send, drop)
+        _context.job = job
+        try:
+            # Recipes added or edited since the last install have to be seen before resolving
+            get_index(os.getenv("LXPKG_PATH", "/usr/src/lxpkg/repo")).refresh()
+            job.closure = set(Resolver().resolve(targets))
+        except (Exception, SystemExit) as e:
+            job.finish(False, f"Installation failed for {', '.join(targets)}: {e}")
+        else:
+            self.submit(job)
+            job.finished.wait()
+        finally:
+            _context.job = None
+        if job.ok:
+            job.send({"event": "done", "ok": True, "message": f"Successfully installed {', '.join(targets)}"})
+        else:
+            job.send({"event": "done", "ok": False, "message": job.message or "installation failed"})
+        job.close()
+
+    def stop(self):
+        with Daemon.lock:
+            self.running = False
+            Daemon.lock.notify_all()
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+def serve():
+    import signal
+    import socketserver
+    path = socket_path()
+    if os.path.exists(path):
+        sock = connect()
+        if sock:
+            sock.close()
+            die(f"An lxpkg daemon is already listening on {path}")
+        os.unlink(path)
+    daemon = Daemon()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            send_lock = threading.Lock()
+
+            def send(event):
+                with send_lock:
+                    self.wfile.write(json.dumps(event).encode() + b"\n")
+                    self.wfile.flush()
+
+            def drop():
+                # Unblocks a writer stuck on a full socket; the client sees its connection closed
+                try:
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+            for line in self.rfile:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    send({"event": "done", "ok": False, "message": "invalid request"})
+                    continue
+                daemon.handle(message, send, drop)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    old_umask = os.umask(0o177)
+    try:
+        server = daemon.server = Server(path, Handler)
+    finally:
+        os.umask(old_umask)
+    sys.stdout = _Output(daemon, sys.stdout)
+    # Nobody can answer a prompt from here: with stdin at EOF, prompt() says no instead of waiting on a terminal
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+    coordinator = threading.Thread(target=daemon.coordinate, name="lxpkg-coordinator", daemon=True)
+    coordinator.start()
+    log(f"lxpkg daemon listening on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop()
+        coordinator.join()
+        server.server_close()
+        os.unlink(path)
+        log("lxpkg daemon stopped")
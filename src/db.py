@@ -0,0 +1,205 @@
+import os
+import time
+import fcntl
+import sqlite3
+import threading
+from contextlib import contextmanager
+from src.utils import log, warn
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS packages (
+    name TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    release TEXT NOT NULL,
+    fingerprint TEXT,
+    build_system TEXT,
+    installed_at REAL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, package TEXT NOT NULL) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_package ON files (package);
+CREATE TABLE IF NOT EXISTS depends (
+    package TEXT NOT NULL,
+    dep TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    PRIMARY KEY (package, dep)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS depends_dep ON depends (dep);
+"""
+
+_dbs = {}
+_dbs_lock = threading.Lock()
+
+def _rel(path):
+    return path.strip().lstrip("/").rstrip("/")
+
+class InstalledDB:
+    # Installed packages, their files and dependencies in one sqlite database next to the legacy
+    # per-package directories in sys_db, which are imported on first use
+    def __init__(self, sys_db):
+        self.sys_db = sys_db
+        self.path = os.path.join(os.path.dirname(sys_db.rstrip("/")), "lxpkg.db")
+        self._lock = threading.Lock()
+        # A rollback journal rather than WAL, so unprivileged users can still read the database
+        if os.access(self.path, os.W_OK) or (not os.path.exists(self.path) and _ensure_parent(self.path)):
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA busy_timeout=30000")
+            self.conn.executescript(SCHEMA)
+        elif os.path.exists(self.path):
+            self.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA busy_timeout=30000")
+            return
+        else:
+            # Nothing to open and no permission to create it: read the legacy layout into memory
+            self.conn = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+            self.conn.executescript(SCHEMA)
+        if self._meta("imported") is None:
+            self.import_legacy()
+
+    def _meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, fn, *args):
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(*args)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return result
+
+    def import_legacy(self):
+        # Only needed once per system, so the manifest parser stays out of every other command's imports
+        from src.manifest import load_manifest, file_paths
+        count = 0
+
+        def do_import():
+            nonlocal count
+            if os.path.isdir(self.sys_db):
+                for name in sorted(os.listdir(self.sys_db)):
+                    pkg_dir = os.path.join(self.sys_db, name)
+                    try:
+                        with open(os.path.join(pkg_dir, "version")) as f:
+                            version = f.read().split()
+                    except (FileNotFoundError, NotADirectoryError):
+                        continue
+                    depends = _read_lines(os.path.join(pkg_dir, "depends"))
+                    files = file_paths(load_manifest(os.path.join(pkg_dir, "manifest")) or [])
+                    record = (_read_lines(os.path.join(pkg_dir, "fingerprint")) or [""])[0].split()
+                    self._record(name, version[0] if version else "", version[1] if len(version) > 1 else "0",
+                                 depends, files, record[0] if len(record) == 2 else None,
+                                 record[1] if len(record) == 2 else None, os.stat(pkg_dir).st_mtime)
+                    count += 1
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('imported', ?)", (str(time.time()),))
+
+        self._write(do_import)
+        if count:
+            log(f"Imported {count} installed packages from {self.sys_db} into {self.path}")
+
+    def _record(self, name, version, release, depends, files, fingerprint, build_system, installed_at):
+        # Only writes need it; read-only commands never load the recipe modules
+        from src.pkg import parse_depends
+        self.conn.execute("DELETE FROM files WHERE package = ?", (name,))
+        self.conn.execute("DELETE FROM depends WHERE package = ?", (name,))
+        self.conn.execute("INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?)",
+                          (name, version, release, fingerprint, build_system, installed_at))
+        # A path installed by this package now belongs to it, even if another package owned it before
+        self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?)",
+                              ((_rel(f), name) for f in files if f.strip() and not f.endswith("/")))
+        self.conn.executemany("INSERT OR REPLACE INTO depends VALUES (?, ?, ?)",
+                              ((name, dep, kind) for dep, kind in parse_depends(depends).items()))
+
+    def record_install(self, name, version, release, depends, files, fingerprint=None, build_system=None):
+        self._write(self._record, name, version, release, depends, files, fingerprint, build_system, time.time())
+
+    def remove(self, name):
+        def do_remove():
+            self.conn.execute("DELETE FROM files WHERE package = ?", (name,))
+            self.conn.execute("DELETE FROM depends WHERE package = ?", (name,))
+            self.conn.execute("DELETE FROM packages WHERE name = ?", (name,))
+        self._write(do_remove)
+
+    def get(self, name):
+        with self._lock:
+            return self.conn.execute("SELECT name, version, release, fingerprint, build_system FROM packages WHERE name = ?",
+                                     (name,)).fetchone()
+
+    def packages(self):
+        with self._lock:
+            return self.conn.execute("SELECT name, version, release FROM packages ORDER BY name").fetchall()
+
+    def files(self, name):
+        with self._lock:
+            return [row[0] for row in self.conn.execute("SELECT path FROM files WHERE package = ? ORDER BY path", (name,))]
+
+    def owner(self, path):
+        with self._lock:
+            row = self.conn.execute("SELECT package FROM files WHERE path = ?", (_rel(path),)).fetchone()
+        return row[0] if row else None
+
+    def reverse_depends(self, name):
+        with self._lock:
+            return [row[0] for row in self.conn.execute("SELECT package FROM depends WHERE dep = ? ORDER BY package", (name,))]
+
+    def fingerprint(self, name):
+        row = self.get(name)
+        if row is None or row[3] is None:
+            return None
+        return row[3], row[4]
+
+    def conflicts(self, name, files):
+        # Paths that some other installed package already owns
+        with self._lock:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS candidate (path TEXT PRIMARY KEY) WITHOUT ROWID")
+            self.conn.execute("DELETE FROM candidate")
+            self.conn.executemany("INSERT OR IGNORE INTO candidate VALUES (?)",
+                                  ((_rel(f),) for f in files if f.strip() and not f.endswith("/")))
+            rows = self.conn.execute("SELECT files.path, files.package FROM candidate JOIN files ON files.path = candidate.path "
+                                     "WHERE files.package != ? ORDER BY files.path", (name,)).fetchall()
+            self.conn.execute("DELETE FROM candidate")
+        return rows
+
+def _ensure_parent(path):
+    parent = os.path.dirname(path)
+    while not os.path.isdir(parent):
+        parent = os.path.dirname(parent)
+    if os.access(parent, os.W_OK):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return True
+    return False
+
+def _read_lines(path):
+    try:
+        with open(path) as f:
+            return [line.rstrip("\n") for line in f if line.strip()]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+@contextmanager
+def install_lock(sys_db):
+    # Held while a run resolves, builds and installs, so concurrent lxpkg processes take turns on the same root
+    path = os.path.join(os.path.dirname(sys_db.rstrip("/")), "lock")
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log("Waiting for another lxpkg install to finish...")
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def open_db(sys_db):
+    with _dbs_lock:
+        db = _dbs.get(sys_db)
+        if db is None:
+            try:
+                db = _dbs[sys_db] = InstalledDB(sys_db)
+            except sqlite3.Error as e:
+                warn(f"Failed to open package database for {sys_db}: {e}")
+                raise
+        return db
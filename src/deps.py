@@ -1,33 +1,104 @@
 from src.pkg import Package
-from src.main import log, warn, prompt, print_info
-import os
+from src.utils import log, warn, prompt
+from src.trace import span
 
-def resolve_dependencies(pkg):
-    seen = set()
-    stack = []
-    deps = []
+class Resolver:
+    # Loads every package once and walks the dependency graph iteratively, so resolution stays
+    # linear in the number of edges however deep the graph is
+    def __init__(self, repo=None):
+        self.repo = repo
+        self.packages = {}
+        self.edges = {}
+        self.missing = set()
+        self.order = []
 
-    def resolve(pkg_name):
-        if pkg_name in seen:
-            return
-        if pkg_name in stack:
-            warn(f"Circular dependency detected involving {pkg_name}")
-            return
-        stack.append(pkg_name)
+    def load(self, name, required=False):
+        if name in self.packages:
+            return self.packages[name]
+        if name in self.missing:
+            return None
         try:
-            pkg = Package(pkg_name)
-            for dep in pkg.depends:
-                dep = dep.split()[0]  # Ignore make/run type
-                resolve(dep)
-            if pkg_name not in seen:
-                deps.append(pkg_name)
-                seen.add(pkg_name)
+            pkg = Package(name, self.repo)
         except Exception as e:
-            warn(f"Dependency {pkg_name} not found: {e}")
-            if not prompt(f"Dependency {pkg_name} is missing. Continue?"):
-                raise Exception(f"Aborted due to missing dependency {pkg_name}")
-        stack.pop()
+            if required:
+                raise
+            warn(f"Dependency {name} not found: {e}")
+            if not prompt(f"Dependency {name} is missing. Continue?"):
+                raise Exception(f"Aborted due to missing dependency {name}")
+            self.missing.add(name)
+            return None
+        self.packages[name] = pkg
+        self.edges[name] = [(dep, kind) for dep, kind in pkg.dep_kinds.items() if dep != name]
+        return pkg
 
-    log(f"Resolving dependencies for {pkg.name}...")
-    resolve(pkg.name)
-    return deps
+    def resolve(self, targets):
+        with span("resolve") as s:
+            order = self._resolve(targets)
+            s.add("packages", len(order))
+            s.add("edges", sum(len(self.edges[name]) for name in order))
+        return order
+
+    def _resolve(self, targets):
+        # Tarjan's algorithm: components come out dependencies first, which is the install order,
+        # and any component with more than one package is a cycle
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        order = []
+        log(f"Resolving dependencies for {', '.join(targets)}...")
+
+        def visit(name):
+            index[name] = low[name] = len(index)
+            stack.append(name)
+            on_stack.add(name)
+            return (name, iter(self.edges[name]))
+
+        for target in targets:
+            if target in index:
+                continue
+            self.load(target, required=True)
+            work = [visit(target)]
+            while work:
+                name, edges = work[-1]
+                for dep, _ in edges:
+                    if dep not in index:
+                        if self.load(dep) is None:
+                            continue
+                        work.append(visit(dep))
+                        break
+                    if dep in on_stack:
+                        low[name] = min(low[name], index[dep])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[name])
+                    if low[name] == index[name]:
+                        component = []
+                        while True:
+                            node = stack.pop()
+                            on_stack.discard(node)
+                            component.append(node)
+                            if node == name:
+                                break
+                        if len(component) > 1:
+                            warn(f"Circular dependency between {', '.join(sorted(component))}")
+                        order.extend(component)
+        self.order = order
+        return order
+
+    def prune(self, targets, needed, prebuilt=()):
+        # Keeps the packages in needed that the targets still pull in; make-only dependencies of
+        # packages installed from a binary package are not needed at all
+        keep = set()
+        work = [name for name in targets if name in needed]
+        while work:
+            name = work.pop()
+            if name in keep:
+                continue
+            keep.add(name)
+            for dep, kind in self.edges[name]:
+                if dep in needed and dep not in keep and not (kind == "make" and name in prebuilt):
+                    work.append(dep)
+        return [name for name in self.order if name in keep]
@@ -0,0 +1,278 @@
+import os
+import re
+import time
+import threading
+import http.client
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from src.utils import log, print_info
+from src.hashing import Hasher, hash_file
+from src.trace import span, count
+
+CHUNK_SIZE = 1 << 20
+MAX_REDIRECTS = 5
+
+class DownloadError(Exception):
+    pass
+
+class _CountingReader:
+    def __init__(self, response, status):
+        self.response = response
+        self.status = status
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.response.read(size)
+        self.count += len(data)
+        return data
+
+    def getheader(self, name, default=None):
+        return self.response.headers.get(name, default)
+
+def _validator_path(dest):
+    return f"{dest}.validator"
+
+def _validator(response):
+    # What If-Range can compare against: a strong ETag, else Last-Modified; weak ETags don't qualify
+    etag = response.getheader("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.getheader("Last-Modified")
+
+def _read_validator(dest):
+    try:
+        with open(_validator_path(dest)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def _save_validator(dest, response):
+    validator = _validator(response)
+    if validator:
+        with open(_validator_path(dest), "w") as f:
+            f.write(f"{validator}\n")
+    else:
+        _discard_validator(dest)
+
+def _discard_validator(dest):
+    try:
+        os.unlink(_validator_path(dest))
+    except FileNotFoundError:
+        pass
+
+def _range_start(response):
+    # Start offset of a 206 body, from "Content-Range: bytes <start>-<end>/<size>"
+    match = re.fullmatch(r"bytes (\d+)-\d+/(?:\d+|\*)", (response.getheader("Content-Range") or "").strip())
+    return int(match.group(1)) if match else None
+
+def _unsatisfied_size(response):
+    # Size of the full resource from a 416's "Content-Range: bytes */<size>"
+    match = re.fullmatch(r"bytes \*/(\d+)", (response.getheader("Content-Range") or "").strip())
+    return int(match.group(1)) if match else None
+
+def _hash_prefix(path):
+    sha256 = Hasher()
+    with span("checksum", bytes=os.path.getsize(path)), open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256
+
+class Downloader:
+    def __init__(self, jobs=None, per_host=None, retries=None, timeout=60):
+        self.jobs = jobs or int(os.getenv("LXPKG_DOWNLOAD_JOBS") or 8)
+        self.per_host = per_host or int(os.getenv("LXPKG_HOST_JOBS") or 4)
+        self.retries = retries if retries is not None else int(os.getenv("LXPKG_RETRIES") or 3)
+        self.timeout = timeout
+        self.bytes = 0
+        self.files = 0
+        self.elapsed = 0.0
+        self._pool = ThreadPoolExecutor(self.jobs, thread_name_prefix="lxpkg-download")
+        self._idle = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._active = 0
+        self._active_since = 0.0
+
+    def submit(self, fn, *args):
+        return self._pool.submit(fn, *args)
+
+    def _host_slot(self, host):
+        with self._lock:
+            slot = self._slots.get(host)
+            if slot is None:
+                slot = self._slots[host] = threading.BoundedSemaphore(self.per_host)
+            return slot
+
+    def _connect(self, host):
+        scheme, netloc = host
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _request(self, host, path, headers):
+        # Reuse a kept-alive connection to the same host when one is idle
+        with self._lock:
+            idle = self._idle.get(host)
+            conn = idle.pop() if idle else None
+        if conn is not None:
+            try:
+                conn.request("GET", path, headers=headers)
+                return conn, conn.getresponse()
+            except (OSError, http.client.HTTPException):
+                # The server may have closed the idle connection; fall back to a fresh one
+                conn.close()
+        conn = self._connect(host)
+        conn.request("GET", path, headers=headers)
+        return conn, conn.getresponse()
+
+    def _release(self, host, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        with self._lock:
+            self._idle.setdefault(host, []).append(conn)
+
+    def _start(self):
+        with self._lock:
+            if self._active == 0:
+                self._active_since = time.monotonic()
+            self._active += 1
+
+    def _finish(self, nbytes):
+        with self._lock:
+            self._active -= 1
+            self.bytes += nbytes
+            self.files += 1
+            if self._active == 0:
+                self.elapsed += time.monotonic() - self._active_since
+
+    @contextmanager
+    def open(self, url, offset=0, validator=None):
+        # Yields a readable response for url, holding a per-host slot until the body is consumed. With an
+        # offset, a range is requested, only honoured by the server while the resource still matches validator
+        self._start()
+        stream = None
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                parsed = urllib.parse.urlsplit(url)
+                if parsed.scheme not in ("http", "https"):
+                    with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                        stream = _CountingReader(response, 200)
+                        yield stream
+                    return
+                host = (parsed.scheme, parsed.netloc)
+                path = urllib.parse.urlunsplit(("", "", parsed.path or "/", parsed.query, ""))
+                headers = {"User-Agent": "lxpkg", "Accept-Encoding": "identity"}
+                if offset:
+                    headers["Range"] = f"bytes={offset}-"
+                    if validator:
+                        headers["If-Range"] = validator
+                with self._host_slot(host):
+                    conn, response = self._request(host, path, headers)
+                    if response.status in (301, 302, 303, 307, 308):
+                        location = response.getheader("Location")
+                        response.read()
+                        self._release(host, conn, response)
+                        if not location:
+                            raise DownloadError(f"Redirect without location from {url}")
+                        url = urllib.parse.urljoin(url, location)
+                        continue
+                    if response.status not in (200, 206) and not (response.status == 416 and offset):
+                        response.read()
+                        self._release(host, conn, response)
+                        raise DownloadError(f"HTTP {response.status} {response.reason} for {url}")
+                    stream = _CountingReader(response, response.status)
+                    try:
+                        yield stream
+                        response.read()
+                    except BaseException:
+                        conn.close()
+                        raise
+                    self._release(host, conn, response)
+                    return
+            raise DownloadError(f"Too many redirects for {url}")
+        finally:
+            self._finish(stream.count if stream else 0)
+
+    def fetch(self, url, dest):
+        # Downloads url into dest, resuming a partial dest; returns the sha256 of the complete file
+        with span("download", url=url) as s:
+            for attempt in range(self.retries + 1):
+                try:
+                    digest = self._fetch_once(url, dest)
+                    s.add("bytes", os.path.getsize(dest))
+                    _discard_validator(dest)
+                    return digest
+                except (OSError, http.client.HTTPException, DownloadError) as e:
+                    if attempt == self.retries:
+                        raise
+                    count("download-retries")
+                    log(f"Retrying {url} after error: {e}")
+                    time.sleep(2 ** attempt)
+
+    def _fetch_once(self, url, dest):
+        offset = os.path.getsize(dest) if os.path.exists(dest) else 0
+        validator = _read_validator(dest) if offset else None
+        if offset and not validator:
+            # Nothing to tell whether the partial file still belongs to what the server has now
+            offset = 0
+        with self.open(url, offset, validator) as response:
+            if response.status == 416:
+                # Only a partial file that is exactly the whole resource is complete; anything else is stale
+                if _unsatisfied_size(response) == offset:
+                    with span("checksum", bytes=offset):
+                        return hash_file(dest)
+                restart = True
+            elif response.status == 206 and _range_start(response) != offset:
+                restart = True
+            else:
+                restart = False
+                if response.status == 206:
+                    log(f"Resuming {url} at {offset} bytes")
+                    sha256 = _hash_prefix(dest)
+                    mode = "ab"
+                else:
+                    # A full response: the resource changed since the partial file was written, or was never partial
+                    _save_validator(dest, response)
+                    sha256 = Hasher()
+                    mode = "wb"
+                received = 0
+                with open(dest, mode) as f:
+                    while chunk := response.read(CHUNK_SIZE):
+                        sha256.update(chunk)
+                        f.write(chunk)
+                        received += len(chunk)
+                length = response.getheader("Content-Length")
+                if length is not None and received < int(length):
+                    raise DownloadError(f"Connection closed after {received} of {length} bytes")
+                return sha256.hexdigest()
+        log(f"Discarding the partial download of {url}, which no longer matches the server")
+        os.truncate(dest, 0)
+        _discard_validator(dest)
+        return self._fetch_once(url, dest)
+
+    def report(self):
+        if not self.files:
+            return
+        rate = self.bytes / self.elapsed / (1 << 20) if self.elapsed else 0.0
+        print_info(f"Downloaded {self.files} files, {self.bytes / (1 << 20):.1f} MiB in {self.elapsed:.1f}s ({rate:.1f} MiB/s)")
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+_downloader = None
+_downloader_lock = threading.Lock()
+
+def get_downloader():
+    global _downloader
+    with _downloader_lock:
+        if _downloader is None:
+            _downloader = Downloader()
+        return _downloader
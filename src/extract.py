@@ -0,0 +1,463 @@
+import os
+import stat
+import time
+import errno
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from src.install import default_jobs
+
+HEAD_SIZE = 512
+CHUNK_SIZE = 1 << 20
+SMALL_FILE = 1 << 20
+BATCH_FILES = 256
+BATCH_BYTES = 8 << 20
+
+MAGIC = (
+    (b"\x1f\x8b", "gz"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zst"),
+    (b"LZIP", "lz"),
+)
+ZIP_MAGIC = (b"PK\x03\x04", b"PK\x05\x06")
+
+# External decompressors in order of preference; they run in their own process (and threads, where supported)
+# while this one parses the tar stream and writes files
+DECOMPRESSORS = {
+    "gz": (["pigz", "-dc"], ["gzip", "-dc"]),
+    "bz2": (["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]),
+    "xz": (["xz", "-dc", "-T0"],),
+    "zst": (["zstd", "-dcq"],),
+    "lz": (["plzip", "-dc"], ["lzip", "-dc"]),
+}
+STREAM_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz", ".tar.zst", ".tzst", ".tar.lz")
+
+_tools = {}
+
+def streamable(filename):
+    # Only names that promise a tarball are extracted while downloading; anything else is sniffed once cached
+    return filename.endswith(STREAM_SUFFIXES)
+
+def sniff(head):
+    # Returns (kind, compression) from the first bytes of a file: kind is "tar", "zip" or None
+    if head.startswith(ZIP_MAGIC):
+        return "zip", None
+    for magic, compression in MAGIC:
+        if head.startswith(magic):
+            return "tar", compression
+    if head[257:262] == b"ustar":
+        return "tar", None
+    return None, None
+
+def archive_format(path):
+    with open(path, "rb") as f:
+        head = f.read(HEAD_SIZE)
+    kind, compression = sniff(head)
+    if kind == "tar" and compression:
+        # A compressed file is not necessarily a tarball (think foo.patch.gz); peek inside where Python can
+        inner = _peek(path, compression)
+        if inner is not None and inner[257:262] != b"ustar":
+            return None, compression
+    return kind, compression
+
+def _peek(path, compression):
+    try:
+        with _python_decompressor(open(path, "rb"), compression) as f:
+            return f.read(HEAD_SIZE)
+    except (OSError, EOFError, ValueError, ImportError):
+        return None
+
+def _tool(compression):
+    if compression not in _tools:
+        _tools[compression] = None
+        if os.getenv("LXPKG_EXTRACT_TOOLS", "1") == "1":
+            for command in DECOMPRESSORS[compression]:
+                if shutil.which(command[0]):
+                    _tools[compression] = command
+                    break
+    return _tools[compression]
+
+def _python_decompressor(fileobj, compression):
+    if compression == "gz":
+        import gzip
+        return gzip.GzipFile(fileobj=fileobj)
+    if compression == "bz2":
+        import bz2
+        return bz2.BZ2File(fileobj)
+    if compression == "xz":
+        import lzma
+        return lzma.LZMAFile(fileobj)
+    if compression == "zst":
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=True)
+    raise OSError(f"No decompressor available for .{compression} (install lzip or plzip)")
+
+def _feed(fileobj, stdin, errors):
+    # Copies the compressed stream into the decompressor; keeps reading after it exits, so callers
+    # hashing the input still see every byte
+    try:
+        while chunk := fileobj.read(CHUNK_SIZE):
+            if stdin:
+                try:
+                    stdin.write(chunk)
+                except BrokenPipeError:
+                    stdin = None
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        if stdin:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+@contextmanager
+def decompressed(source, compression):
+    # source is a path or a readable file object; yields the uncompressed stream
+    if compression is None:
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                yield f
+        else:
+            yield source
+        return
+    command = _tool(compression)
+    if command is None:
+        fileobj = open(source, "rb") if isinstance(source, str) else source
+        with _python_decompressor(fileobj, compression) as f:
+            yield f
+        return
+    errors = []
+    feeder = None
+    if isinstance(source, str):
+        proc = subprocess.Popen(command + [source], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    else:
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        feeder = threading.Thread(target=_feed, args=(source, proc.stdin, errors), daemon=True)
+        feeder.start()
+    try:
+        yield proc.stdout
+        # tar stops at its end-of-archive marker; let the decompressor finish instead of killing it with SIGPIPE
+        while proc.stdout.read(CHUNK_SIZE):
+            pass
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        stderr = proc.stderr.read().decode(errors="replace").strip()
+        proc.stderr.close()
+        returncode = proc.wait()
+        if feeder:
+            feeder.join()
+    if errors:
+        raise errors[0]
+    if returncode != 0:
+        raise OSError(f"{command[0]} exited with status {returncode}: {stderr}")
+
+def _write_batch(batch):
+    for path, data, mode, mtime in batch:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+        except OSError as e:
+            if e.errno != errno.ELOOP:
+                raise
+            # A symlink from an earlier entry; the file replaces it rather than writing through it
+            os.unlink(path)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fchmod(fd, mode)
+        finally:
+            os.close(fd)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime), follow_symlinks=False)
+
+def _merge_tree(src, dst):
+    os.makedirs(dst, exist_ok=True)
+    for name in os.listdir(src):
+        source, target = os.path.join(src, name), os.path.join(dst, name)
+        if os.path.isdir(source) and not os.path.islink(source) and os.path.isdir(target) and not os.path.islink(target):
+            _merge_tree(source, target)
+        else:
+            os.replace(source, target)
+    os.rmdir(src)
+
+class _Writer:
+    # Small files are handed to worker threads in batches; large files, links and directories are written in order
+    def __init__(self, dest, jobs=None):
+        self.dest = os.path.abspath(dest)
+        self.real_dest = None
+        self.jobs = jobs or int(os.getenv("LXPKG_EXTRACT_JOBS") or default_jobs())
+        self.pool = ThreadPoolExecutor(self.jobs, thread_name_prefix="lxpkg-extract")
+        self.batch = []
+        self.batch_bytes = 0
+        self.pending = []
+        self.queued = set()
+        self.made = set()
+        self.links = set()
+        self.top = set()
+        self.dirs = []
+        self.files = 0
+        self.bytes = 0
+        os.makedirs(self.dest, exist_ok=True)
+
+    def _through_link(self, path, parts):
+        # Nothing is written (or hard linked) through a symlink the archive itself created
+        parent = os.path.dirname(path)
+        while self.links and parent != self.dest:
+            if parent in self.links:
+                raise ValueError(f"{'/'.join(parts)} would be extracted through a symlink")
+            parent = os.path.dirname(parent)
+
+    def _inside(self, path):
+        # Symlinks are resolved like tarfile's "data" filter does: through the links already on disk
+        if self.real_dest is None:
+            self.real_dest = os.path.realpath(self.dest)
+        resolved = os.path.realpath(path)
+        return resolved == self.real_dest or resolved.startswith(self.real_dest + os.sep)
+
+    def path(self, parts):
+        self.top.add(parts[0])
+        path = os.path.join(self.dest, *parts)
+        self._through_link(path, parts)
+        if path in self.queued:
+            # The same path twice in one archive: the later entry has to land last
+            self.flush()
+        parent = os.path.dirname(path)
+        if parent not in self.made:
+            os.makedirs(parent, exist_ok=True)
+            self.made.add(parent)
+        return path
+
+    def directory(self, parts, mode, mtime):
+        path = self.path(parts)
+        if path not in self.made:
+            os.makedirs(path, exist_ok=True)
+            self.made.add(path)
+        # Modes and times of directories are applied at the end, once nothing is written into them anymore
+        self.dirs.append((path, mode, mtime))
+
+    def file(self, parts, data, mode, mtime):
+        path = self.path(parts)
+        self.batch.append((path, data, mode, mtime))
+        self.queued.add(path)
+        self.batch_bytes += len(data)
+        self.files += 1
+        self.bytes += len(data)
+        if len(self.batch) >= BATCH_FILES or self.batch_bytes >= BATCH_BYTES:
+            self._submit()
+
+    def large_file(self, parts, stream, mode, mtime):
+        path = self.path(parts)
+        if os.path.islink(path):
+            os.unlink(path)
+        with open(path, "wb") as f:
+            while chunk := stream.read(CHUNK_SIZE):
+                f.write(chunk)
+                self.bytes += len(chunk)
+        os.chmod(path, mode)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        self.files += 1
+
+    def symlink(self, parts, target):
+        path = self.path(parts)
+        if os.path.isabs(target) or not self._inside(os.path.join(os.path.dirname(path), target)):
+            raise ValueError(f"{'/'.join(parts)} links outside the extraction directory ({target})")
+        if os.path.lexists(path):
+            os.unlink(path)
+        os.symlink(target, path)
+        self.links.add(path)
+        self.files += 1
+
+    def hardlink(self, parts, target_parts):
+        path = self.path(parts)
+        target = os.path.join(self.dest, *target_parts)
+        self._through_link(target, target_parts)
+        self.flush()
+        if os.path.lexists(path):
+            os.unlink(path)
+        try:
+            os.link(target, path, follow_symlinks=False)
+        except OSError:
+            shutil.copy2(target, path, follow_symlinks=False)
+        self.files += 1
+
+    def _submit(self):
+        if self.batch:
+            self.pending.append(self.pool.submit(_write_batch, self.batch))
+            self.batch = []
+            self.batch_bytes = 0
+            # Bounded read-ahead, so a huge archive does not end up in memory
+            while len(self.pending) > self.jobs * 2:
+                self.pending.pop(0).result()
+
+    def flush(self):
+        self._submit()
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        self.queued.clear()
+
+    def unstrip(self, prefix):
+        # The archive turned out not to have a single top-level directory: put what was stripped back under it
+        self.flush()
+        holder = tempfile.mkdtemp(prefix=".lxpkg-unstrip-", dir=self.dest)
+        for name in self.top:
+            os.rename(os.path.join(self.dest, name), os.path.join(holder, name))
+        _merge_tree(holder, os.path.join(self.dest, prefix))
+        self.top = {prefix}
+        moved = os.path.join(self.dest, prefix)
+        remap = lambda path: moved + path[len(self.dest):]
+        self.made = {remap(path) for path in self.made}
+        self.links = {remap(path) for path in self.links}
+        self.dirs = [(remap(path), mode, mtime) for path, mode, mtime in self.dirs]
+
+    def finish(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown()
+        for path in self.links:
+            # A link that was dangling when checked may lead outside through one created after it
+            if os.path.islink(path) and not self._inside(path):
+                os.unlink(path)
+                raise ValueError(f"{os.path.relpath(path, self.dest)} links outside the extraction directory")
+        for path, mode, mtime in sorted(self.dirs, reverse=True):
+            os.chmod(path, mode)
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+        return {"files": self.files, "bytes": self.bytes}
+
+    def abort(self):
+        self.pool.shutdown(cancel_futures=True)
+
+def _parts(name):
+    # Leading slashes are dropped like tar does; ".." never gets past this
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if ".." in parts:
+        raise ValueError(f"{name} points outside the extraction directory")
+    return parts
+
+def _safe_mode(mode, directory=False):
+    # Same rules as tarfile's "data" filter: no setuid/setgid/sticky or group/other write, owner can always write
+    mode = (mode if mode is not None else 0o644) & 0o755
+    return mode | (0o700 if directory else 0o600)
+
+def _extract_tar(stream, dest, strip):
+    writer = _Writer(dest)
+    prefix = None
+    try:
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                parts = _parts(member.name)
+                if not parts:
+                    continue
+                link_parts = _parts(member.linkname) if member.islnk() else None
+                if prefix is None:
+                    # The first entry decides; a later entry outside that directory undoes it
+                    prefix = parts[0] if strip and (len(parts) > 1 or member.isdir()) else False
+                if prefix:
+                    if parts[0] == prefix:
+                        parts = parts[1:]
+                        if link_parts and link_parts[0] == prefix:
+                            link_parts = link_parts[1:]
+                    else:
+                        writer.unstrip(prefix)
+                        prefix = False
+                        link_parts = _parts(member.linkname) if member.islnk() else None
+                    if not parts:
+                        continue
+                mtime = member.mtime
+                if member.isdir():
+                    writer.directory(parts, _safe_mode(member.mode, True), mtime)
+                elif member.isreg():
+                    source = tar.extractfile(member)
+                    if member.size <= SMALL_FILE:
+                        writer.file(parts, source.read(), _safe_mode(member.mode), mtime)
+                    else:
+                        writer.large_file(parts, source, _safe_mode(member.mode), mtime)
+                elif member.issym():
+                    writer.symlink(parts, member.linkname)
+                elif member.islnk():
+                    writer.hardlink(parts, link_parts)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.finish()
+
+def _zip_mode(info):
+    mode = info.external_attr >> 16
+    return mode if mode else (0o755 if info.is_dir() else 0o644)
+
+def _extract_zip(path, dest, strip):
+    writer = _Writer(dest)
+    try:
+        with zipfile.ZipFile(path) as zf:
+            infos = [(info, _parts(info.filename)) for info in zf.infolist()]
+            infos = [(info, parts) for info, parts in infos if parts]
+            tops = {parts[0] for _, parts in infos}
+            strip = strip and len(tops) == 1 and all(len(parts) > 1 or info.is_dir() for info, parts in infos)
+            for info, parts in infos:
+                parts = parts[1:] if strip else parts
+                if not parts:
+                    continue
+                mode = _zip_mode(info)
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                if info.is_dir():
+                    writer.directory(parts, _safe_mode(mode, True), mtime)
+                elif stat.S_ISLNK(mode):
+                    writer.symlink(parts, zf.read(info).decode())
+                elif info.file_size <= SMALL_FILE:
+                    writer.file(parts, zf.read(info), _safe_mode(mode), mtime)
+                else:
+                    with zf.open(info) as source:
+                        writer.large_file(parts, source, _safe_mode(mode), mtime)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.finish()
+
+def extract_archive(path, dest, strip=True):
+    # Unpacks a tarball (any supported compression) or zip into dest; with strip, a single top-level
+    # directory is dropped as entries are written. Returns {"files": ..., "bytes": ...}
+    kind, compression = archive_format(path)
+    if kind == "zip":
+        return _extract_zip(path, dest, strip)
+    if kind != "tar":
+        raise ValueError(f"{os.path.basename(path)} is not a supported archive")
+    with decompressed(path, compression) as stream:
+        return _extract_tar(stream, dest, strip)
+
+class _Prefixed:
+    # Puts the sniffed bytes back in front of a stream
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        if self.head:
+            if size is None or size < 0:
+                data, self.head = self.head + self.stream.read(), b""
+                return data
+            data, self.head = self.head[:size], self.head[size:]
+            return data
+        return self.stream.read(size)
+
+def extract_stream(stream, dest, strip=True):
+    # Like extract_archive, for a tarball arriving on a non-seekable stream
+    head = stream.read(HEAD_SIZE)
+    kind, compression = sniff(head)
+    if kind != "tar":
+        raise ValueError("stream is not a tarball")
+    with decompressed(_Prefixed(head, stream), compression) as data:
+        return _extract_tar(data, dest, strip)
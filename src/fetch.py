@@ -1,67 +1,204 @@
 import os
-import urllib.request
-import tarfile
-import zipfile
-import subprocess
+import shutil
+import tempfile
+import threading
 from src.utils import log, warn, die, print_success, print_info, prompt
+from src.cache import SourceCache, url_key
+from src.download import get_downloader
+from src.hashing import Hasher
+from src.trace import span, count
+from src.extract import archive_format, extract_archive, extract_stream, streamable
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+_extracted = set()
+
+def streaming_enabled():
+    return os.getenv("LXPKG_STREAM", "1") == "1"
+
+class _TeeReader:
+    # Feeds every byte read by the extractor into the hasher and the cache file
+    def __init__(self, stream, sha256, out):
+        self.stream = stream
+        self.sha256 = sha256
+        self.out = out
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.sha256.update(data)
+        self.out.write(data)
+        return data
+
+    def drain(self):
+        while self.read(1 << 20):
+            pass
+
+def _expected_checksum(pkg, filename):
+    if filename in pkg.checksums and os.getenv("LXPKG_SKIP_CHECKSUMS") != "1":
+        return pkg.checksums[filename]
+    return None
+
+def download_source(cache, url, filename, expected=None):
+    # Partial downloads are kept in the cache tmp dir and resumed on the next attempt
+    tmp = cache.tmp_path(expected or url_key(url))
+    print_info(f"Downloading {filename}...")
+    try:
+        actual = get_downloader().fetch(url, tmp)
+        print_success(f"Downloaded {filename}")
+    except Exception as e:
+        die(f"Failed to download {filename}: {e}")
+    # Verify checksum
+    if expected:
+        print_info(f"Verifying checksum for {filename}...")
+        if actual != expected:
+            warn(f"Checksum mismatch for {filename}: expected {expected}, got {actual}")
+            if not prompt("Checksum verification failed. Continue?"):
+                os.unlink(tmp)
+                die(f"Aborted due to checksum mismatch for {filename}")
+            return cache.store(tmp, actual)
+        print_success(f"Checksum verified for {filename}")
+    return cache.store(tmp, actual, url)
+
+def stream_source(cache, url, filename, expected, dest):
+    # Download, hash and untar in a single pass; the tree is only moved into dest once verified
+    key = expected or url_key(url)
+    tmp = cache.tmp_path(key)
+    staging = tempfile.mkdtemp(prefix=f".{os.path.basename(dest)}-", dir=os.path.dirname(dest))
+    sha256 = Hasher()
+    print_info(f"Downloading and extracting {filename}...")
+    try:
+        with span("stream", url=url) as s, get_downloader().open(url) as response, open(tmp, "wb") as f:
+            tee = _TeeReader(response, sha256, f)
+            s.add("files", extract_stream(tee, staging)["files"])
+            # Trailing padding after the end-of-archive marker is part of the checksum too
+            tee.drain()
+            s.add("bytes", f.tell())
+    except Exception as e:
+        warn(f"Streaming extraction of {filename} failed ({e}), falling back to a full download")
+        shutil.rmtree(staging, ignore_errors=True)
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        return None
+    actual = sha256.hexdigest()
+    if expected:
+        if actual != expected:
+            warn(f"Checksum mismatch for {filename}: expected {expected}, got {actual}")
+            if not prompt("Checksum verification failed. Continue?"):
+                shutil.rmtree(staging, ignore_errors=True)
+                os.unlink(tmp)
+                die(f"Aborted due to checksum mismatch for {filename}")
+            expected = None
+            url = None
+        else:
+            print_success(f"Checksum verified for {filename}")
+    os.makedirs(dest, exist_ok=True)
+    for item in os.listdir(staging):
+        target = os.path.join(dest, item)
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.copytree(os.path.join(staging, item), target, symlinks=True, dirs_exist_ok=True)
+        else:
+            os.replace(os.path.join(staging, item), target)
+    shutil.rmtree(staging, ignore_errors=True)
+    cache.store(tmp, actual, url)
+    print_success(f"Downloaded and extracted {filename}")
+    return dest
+
+def _fetch_to_cache(cache, url, filename, expected, extract_to):
+    # Returns (path, extracted): extracted is True when the source was unpacked while streaming
+    key = expected or url_key(url)
+    with cache.lock(key):
+        archive = cache.lookup(expected, url)
+        if archive:
+            return archive, False
+        # A partial download is resumed rather than streamed again from the start
+        if extract_to and not os.path.exists(cache.tmp_path(key)):
+            if stream_source(cache, url, filename, expected, extract_to):
+                with _inflight_lock:
+                    _extracted.add((key, extract_to))
+                return extract_to, True
+        return download_source(cache, url, filename, expected), False
+
+def request_source(cache, url, filename, expected=None, extract_to=None):
+    # Prefetch and fetch_sources share a single download per source
+    key = (expected or url_key(url), extract_to)
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is None:
+            future = _inflight[key] = get_downloader().submit(_fetch_to_cache, cache, url, filename, expected, extract_to)
+            future.add_done_callback(lambda _: _inflight.pop(key, None))
+    return future
+
+def _stream_target(pkg, filename, src_dir):
+    if src_dir and streaming_enabled() and streamable(filename):
+        return os.path.join(src_dir, pkg.name)
+    return None
+
+def prefetch(pkgs, src_dir=None):
+    # Start downloading every uncached source of the install set at once
+    cache = SourceCache()
+    futures = []
+    for pkg in pkgs:
+        for url in pkg.sources:
+            filename = url.split("/")[-1]
+            expected = _expected_checksum(pkg, filename)
+            if not cache.lookup(expected, url):
+                extract_to = _stream_target(pkg, filename, src_dir)
+                futures.append(request_source(cache, url, filename, expected, extract_to))
+    if futures:
+        log(f"Prefetching {len(futures)} sources")
+    return futures
+
+def _extract_source(pkg, archive, filename, src_path):
+    log(f"Extracting {filename} to {src_path}")
+    try:
+        kind, _ = archive_format(archive)
+        if kind is None:
+            warn(f"Unknown archive type for {filename}, skipping extraction")
+            shutil.copyfile(archive, os.path.join(src_path, filename))
+            return
+        # The archive's single top-level directory is stripped while extracting
+        with span("extract", pkg=pkg.name, bytes=os.path.getsize(archive)) as s:
+            s.add("files", extract_archive(archive, src_path)["files"])
+        log(f"Extracted {filename} successfully")
+    except Exception as e:
+        warn(f"Failed to extract {filename}: {e}")
+        if not prompt(f"Extraction failed for {filename}. Continue?"):
+            die(f"Aborted due to extraction failure for {filename}")
 
 def fetch_sources(pkg, src_dir):
     src_path = os.path.join(src_dir, pkg.name)
     os.makedirs(src_path, exist_ok=True)
-    os.chdir(src_path)
     if not pkg.sources:
         warn(f"No sources file found for {pkg.name}")
         if not prompt("No sources found. Continue?"):
             die(f"Aborted due to missing sources for {pkg.name}")
         return
+    cache = SourceCache()
     for url in pkg.sources:
         filename = url.split("/")[-1]
         log(f"Processing source: {url}")
-        if not os.path.exists(filename):
-            print_info(f"Downloading {filename}...")
-            try:
-                urllib.request.urlretrieve(url, filename)
-                print_success(f"Downloaded {filename}")
-            except Exception as e:
-                die(f"Failed to download {filename}: {e}")
-        # Verify checksum
-        if filename in pkg.checksums and os.getenv("LXPKG_SKIP_CHECKSUMS") != "1":
-            print_info(f"Verifying checksum for {filename}...")
-            expected = pkg.checksums[filename]
-            result = subprocess.run(["sha256sum", filename], capture_output=True, text=True)
-            actual = result.stdout.split()[0]
-            if actual != expected:
-                warn(f"Checksum mismatch for {filename}: expected {expected}, got {actual}")
-                if not prompt("Checksum verification failed. Continue?"):
-                    die(f"Aborted due to checksum mismatch for {filename}")
-            print_success(f"Checksum verified for {filename}")
-        # Extract
-        log(f"Extracting {filename} to {src_path}")
-        try:
-            if filename.endswith((".tar.gz", ".tgz")):
-                with tarfile.open(filename, "r:gz") as tar:
-                    tar.extractall(src_path, filter="data")
-            elif filename.endswith((".tar.bz2", ".tbz2")):
-                with tarfile.open(filename, "r:bz2") as tar:
-                    tar.extractall(src_path, filter="data")
-            elif filename.endswith((".tar.xz", ".txz")):
-                with tarfile.open(filename, "r:xz") as tar:
-                    tar.extractall(src_path, filter="data")
-            elif filename.endswith(".zip"):
-                with zipfile.ZipFile(filename, "r") as zip_ref:
-                    zip_ref.extractall(src_path)
-                # Move files from subdirectory if created
-                subdirs = [d for d in os.listdir(src_path) if os.path.isdir(os.path.join(src_path, d))]
-                if len(subdirs) == 1:
-                    subdir = subdirs[0]
-                    for item in os.listdir(os.path.join(src_path, subdir)):
-                        os.rename(os.path.join(src_path, subdir, item), os.path.join(src_path, item))
-                    os.rmdir(os.path.join(src_path, subdir))
-            else:
-                warn(f"Unknown archive type for {filename}, skipping extraction")
+        expected = _expected_checksum(pkg, filename)
+        with _inflight_lock:
+            if (expected or url_key(url), src_path) in _extracted:
+                # Already unpacked here while prefetching
+                _extracted.discard((expected or url_key(url), src_path))
                 continue
-            log(f"Extracted {filename} successfully")
-        except Exception as e:
-            warn(f"Failed to extract {filename}: {e}")
-            if not prompt(f"Extraction failed for {filename}. Continue?"):
-                die(f"Aborted due to extraction failure for {filename}")
+        # Cached files are stored under their sha256, so a hit needs neither download nor verification.
+        # The blob stays locked while it is extracted, so eviction by another install can't pull it away;
+        # if that happened between the download and here, it is simply fetched again
+        digest = expected
+        hit = True
+        while True:
+            with cache.use(digest, url) as archive:
+                if archive:
+                    if hit:
+                        count("cache-hits")
+                        log(f"Using cached {filename}")
+                    _extract_source(pkg, archive, filename, src_path)
+                    break
+            hit = False
+            archive, extracted = request_source(cache, url, filename, expected, _stream_target(pkg, filename, src_dir)).result()
+            if extracted:
+                break
+            # Blobs are named by their sha256, which differs from the expected one when a mismatch was accepted
+            digest = os.path.basename(archive)
@@ -0,0 +1,82 @@
+import os
+import hashlib
+from src.utils import log
+from src.pkg import Package
+
+_build_keys = {}
+
+def reset_build_keys():
+    # Forget cached build keys so edited recipes are hashed again
+    _build_keys.clear()
+
+def metadata_dir(pkg_path, name):
+    return os.path.join(pkg_path, "var/db/lxpkg/installed", name)
+
+def build_key(pkg):
+    # Recipe hash of the package combined with the build keys of everything it depends on,
+    # so a binary package built against an older dependency is never reused
+    if pkg.name in _build_keys:
+        return _build_keys[pkg.name]
+    stack = [(pkg, False)]
+    visiting = set()
+    while stack:
+        node, expanded = stack.pop()
+        if node.name in _build_keys:
+            continue
+        if expanded:
+            sha256 = hashlib.sha256(f"recipe {node.recipe_hash}\n".encode())
+            for dep in sorted(set(node.dep_names)):
+                if dep in _build_keys:
+                    sha256.update(f"depend {dep} {_build_keys[dep]}\n".encode())
+            _build_keys[node.name] = sha256.hexdigest()
+            continue
+        visiting.add(node.name)
+        stack.append((node, True))
+        for dep in node.dep_names:
+            # Dependencies already on the stack are part of a cycle and are left out
+            if dep in _build_keys or dep in visiting:
+                continue
+            try:
+                stack.append((Package(dep), False))
+            except Exception:
+                continue
+    return _build_keys[pkg.name]
+
+def compute_fingerprint(pkg, build_system, fingerprints):
+    # Covers the recipe files, how the package was built and what it was built against
+    sha256 = hashlib.sha256()
+    sha256.update(f"recipe {pkg.recipe_hash}\nbuild-system {build_system}\n".encode())
+    for dep in sorted(fingerprints):
+        sha256.update(f"depend {dep} {fingerprints[dep]}\n".encode())
+    return sha256.hexdigest()
+
+def dep_fingerprints(pkg, db):
+    # Runtime dependencies count with what is installed; make-only dependencies with their build key,
+    # as they do not have to stay installed once the package is built
+    fingerprints = {}
+    for dep, kind in pkg.dep_kinds.items():
+        if kind == "make":
+            try:
+                fingerprints[dep] = build_key(Package(dep))
+            except Exception:
+                continue
+            continue
+        record = db.fingerprint(dep)
+        if record:
+            fingerprints[dep] = record[0]
+    return fingerprints
+
+def stale_packages(pkgs, db):
+    # pkgs come in dependency order; anything with a stale runtime dependency is stale too, while
+    # changed make-only dependencies show up through their build key
+    stale = set()
+    for pkg in pkgs:
+        record = db.fingerprint(pkg.name)
+        if record is None or any(dep in stale for dep, kind in pkg.dep_kinds.items() if kind == "run"):
+            stale.add(pkg.name)
+            continue
+        fingerprint, build_system = record
+        if compute_fingerprint(pkg, build_system, dep_fingerprints(pkg, db)) != fingerprint:
+            log(f"{pkg.name} changed since it was installed", verbose_only=True)
+            stale.add(pkg.name)
+    return [pkg for pkg in pkgs if pkg.name in stale]
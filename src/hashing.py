@@ -0,0 +1,30 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+READ_SIZE = 1 << 20
+
+try:
+    from src.checksum import Hasher, hash_file, hash_files
+    NATIVE = True
+except ImportError:
+    # Pure hashlib fallback when the C extension isn't built; hashlib also releases the GIL on large updates
+    NATIVE = False
+
+    Hasher = hashlib.sha256
+
+    def hash_file(path):
+        sha256 = hashlib.sha256()
+        buf = bytearray(READ_SIZE)
+        view = memoryview(buf)
+        with open(path, "rb", buffering=0) as f:
+            while n := f.readinto(buf):
+                sha256.update(view[:n])
+        return sha256.hexdigest()
+
+    def hash_files(paths, threads=0):
+        paths = list(paths)
+        if len(paths) < 2:
+            return [hash_file(path) for path in paths]
+        with ThreadPoolExecutor(min(threads or os.cpu_count() or 1, len(paths))) as pool:
+            return list(pool.map(hash_file, paths))
@@ -0,0 +1,204 @@
+import os
+import json
+import atexit
+import hashlib
+import logging
+import threading
+
+INDEX_FORMAT = 3
+RECIPE_FILES = ("version", "sources", "depends", "checksums", "build", "nostrip")
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def _stamp(pkg_dir):
+    # Directory mtime plus mtime/size of every recipe file, so in-place edits are caught too
+    stamp = [os.stat(pkg_dir).st_mtime_ns]
+    for fname in RECIPE_FILES:
+        try:
+            st = os.stat(os.path.join(pkg_dir, fname))
+            stamp += [st.st_mtime_ns, st.st_size]
+        except FileNotFoundError:
+            stamp += [0, -1]
+    return stamp
+
+def _read_lines(pkg_dir, fname):
+    try:
+        with open(os.path.join(pkg_dir, fname)) as f:
+            return f.read().strip().splitlines()
+    except FileNotFoundError:
+        return None
+
+def recipe_hash(pkg_dir):
+    # Identifies the exact recipe contents; binary packages and build fingerprints are keyed on it
+    sha256 = hashlib.sha256()
+    for fname in RECIPE_FILES:
+        try:
+            with open(os.path.join(pkg_dir, fname), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            continue
+        sha256.update(f"{fname}\0{len(content)}\0".encode())
+        sha256.update(content)
+    return sha256.hexdigest()
+
+def parse_recipe(pkg_dir):
+    version = (_read_lines(pkg_dir, "version") or [""])[0].split()
+    checksums = None
+    bad_checksums = []
+    lines = _read_lines(pkg_dir, "checksums")
+    if lines is not None:
+        checksums = {}
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                checksum, filename = line.split(maxsplit=1)
+                checksums[filename] = checksum
+            except ValueError:
+                bad_checksums.append(line)
+    return {
+        "dir": pkg_dir,
+        "section": os.path.basename(os.path.dirname(pkg_dir)),
+        "stamp": _stamp(pkg_dir),
+        "version": version[0] if version else "",
+        "release": version[1] if len(version) > 1 else "0",
+        "sources": _read_lines(pkg_dir, "sources") or [],
+        "depends": _read_lines(pkg_dir, "depends") or [],
+        "checksums": checksums,
+        "bad_checksums": bad_checksums,
+        "recipe_hash": recipe_hash(pkg_dir),
+    }
+
+class RepoIndex:
+    def __init__(self, repo, path=None):
+        self.repo = os.path.abspath(repo)
+        self.path = path or index_path(self.repo)
+        self.dirs = {}
+        self.packages = {}
+        self._dirty = False
+        # Fetch and build threads look packages up while a daemon may refresh the same index
+        self.lock = threading.RLock()
+        self._load()
+        self.refresh()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("format") != INDEX_FORMAT or data.get("repo") != self.repo:
+            return
+        self.dirs = data["dirs"]
+        self.packages = data["packages"]
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        if not self._dirty:
+            return
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump({"format": INDEX_FORMAT, "repo": self.repo, "dirs": self.dirs, "packages": self.packages}, f)
+            os.replace(tmp, self.path)
+            self._dirty = False
+            logging.debug(f"Saved repository index {self.path} ({len(self.packages)} packages)")
+        except OSError as e:
+            logging.debug(f"Could not save repository index {self.path}: {e}")
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def refresh(self):
+        with self.lock:
+            self._refresh()
+
+    def _refresh(self):
+        # Only directories whose mtime changed are rescanned; package entries are revalidated on lookup
+        changed = []
+        for path, mtime in self.dirs.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    changed.append(path)
+            except FileNotFoundError:
+                changed.append(path)
+        if not self.dirs:
+            changed = [self.repo]
+        for path in sorted(changed):
+            if any(path.startswith(top + os.sep) for top in changed if top != path):
+                continue
+            self._rescan(path)
+
+    def _rescan(self, top):
+        prefix = top + os.sep
+        old = {}
+        for name, entry in list(self.packages.items()):
+            if entry["dir"].startswith(prefix):
+                old[entry["dir"]] = entry
+                del self.packages[name]
+        for path in [d for d in self.dirs if d == top or d.startswith(prefix)]:
+            del self.dirs[path]
+        self._dirty = True
+        if not os.path.isdir(top):
+            return
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            try:
+                self.dirs[path] = os.stat(path).st_mtime_ns
+                children = sorted(e.path for e in os.scandir(path) if e.is_dir())
+            except OSError:
+                continue
+            for child in reversed(children):
+                if os.path.exists(os.path.join(child, "version")):
+                    name = os.path.basename(child)
+                    if name not in self.packages:
+                        self.packages[name] = old.get(child) or {"dir": child, "stamp": None}
+                else:
+                    stack.append(child)
+        logging.debug(f"Rescanned {top} ({len(self.packages)} packages indexed)")
+
+    def lookup(self, name):
+        with self.lock:
+            return self._lookup(name)
+
+    def _lookup(self, name):
+        entry = self.packages.get(name)
+        if entry is None:
+            return None
+        try:
+            stamp = _stamp(entry["dir"])
+        except FileNotFoundError:
+            del self.packages[name]
+            self._dirty = True
+            return None
+        if entry["stamp"] != stamp:
+            entry = self.packages[name] = parse_recipe(entry["dir"])
+            self._dirty = True
+        return entry
+
+    def names(self):
+        with self.lock:
+            return list(self.packages)
+
+def index_path(repo):
+    cache_dir = os.getenv("LXPKG_CACHEDIR", "/var/cache/lxpkg")
+    key = hashlib.sha1(os.path.abspath(repo).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "index", f"{key}.json")
+
+def get_index(repo):
+    # One index per repository per process
+    repo = os.path.abspath(repo)
+    with _indexes_lock:
+        index = _indexes.get(repo)
+        if index is None:
+            index = _indexes[repo] = RepoIndex(repo)
+            atexit.register(index.save)
+    return index
@@ -0,0 +1,163 @@
+import os
+import sys
+import time
+import stat
+import fcntl
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from src.utils import log, warn
+from src.trace import span
+
+FICLONE = 0x40049409
+PROGRESS_INTERVAL = 0.1
+BATCH_SIZE = 256
+
+def default_jobs():
+    # Copies are I/O bound, so use more threads than cores
+    return min(16, (os.cpu_count() or 1) * 2)
+
+def _copy_data(src_fd, dst_fd, size):
+    # Reflink first (btrfs/xfs), then in-kernel copies, then a userspace copy
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return
+    except OSError:
+        pass
+    offset = 0
+    try:
+        while offset < size:
+            n = os.copy_file_range(src_fd, dst_fd, size - offset)
+            if n == 0:
+                break
+            offset += n
+        if offset >= size:
+            return
+    except OSError:
+        pass
+    try:
+        while offset < size:
+            n = os.sendfile(dst_fd, src_fd, offset, size - offset)
+            if n == 0:
+                break
+            offset += n
+        if offset >= size:
+            return
+    except OSError:
+        pass
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    with open(src_fd, "rb", closefd=False) as fsrc, open(dst_fd, "wb", closefd=False) as fdst:
+        shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+def install_file(src, dest):
+    # Written under a temporary name and renamed over dest, so readers never see a partial file
+    tmp = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.lxpkg-new")
+    st = os.lstat(src)
+    if stat.S_ISLNK(st.st_mode):
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        os.symlink(os.readlink(src), tmp)
+        os.replace(tmp, dest)
+        return 0
+    src_fd = os.open(src, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        dst_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, stat.S_IMODE(st.st_mode))
+        try:
+            _copy_data(src_fd, dst_fd, st.st_size)
+            os.fchmod(dst_fd, stat.S_IMODE(st.st_mode))
+            # The package's mtime is kept: upgrades compare it to tell untouched files from edited ones
+            os.utime(dst_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        finally:
+            os.close(dst_fd)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    finally:
+        os.close(src_fd)
+    os.replace(tmp, dest)
+    return st.st_size
+
+def _install_batch(pkg_path, install_root, files):
+    nbytes = 0
+    for f in files:
+        nbytes += install_file(os.path.join(pkg_path, f), os.path.join(install_root, f))
+    return len(files), nbytes
+
+def _progress(name, done, total):
+    percent = (done * 100) // total if total else 100
+    print(f"\r==> Installing {name}: {percent:3d}% [{'#' * (percent // 5)}{' ' * (20 - percent // 5)}]", end="")
+    sys.stdout.flush()
+
+def install_files(name, pkg_path, install_root, entries, jobs=None):
+    files = [e for e in entries if not e.endswith("/") and os.path.lexists(os.path.join(pkg_path, e))]
+    dirs = {e.rstrip("/") for e in entries if e.endswith("/")}
+    dir_count = len(dirs)
+    for f in files:
+        parent = os.path.dirname(f)
+        while parent and parent not in dirs:
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+    # Parents sort before their children, so each directory is created exactly once
+    for d in sorted(dirs):
+        os.makedirs(os.path.join(install_root, d), exist_ok=True)
+    start = time.monotonic()
+    last = 0.0
+    copied = 0
+    nbytes = 0
+    with span("install", pkg=name) as s, \
+            ThreadPoolExecutor(jobs or int(os.getenv("LXPKG_INSTALL_JOBS") or default_jobs())) as pool:
+        # Batches keep per-task overhead low for packages made of many small files
+        futures = [pool.submit(_install_batch, pkg_path, install_root, files[i:i + BATCH_SIZE])
+                   for i in range(0, len(files), BATCH_SIZE)]
+        for future in as_completed(futures):
+            count, size = future.result()
+            copied += count
+            nbytes += size
+            now = time.monotonic()
+            if now - last >= PROGRESS_INTERVAL:
+                last = now
+                _progress(name, copied, len(files))
+        s.add("files", copied)
+        s.add("bytes", nbytes)
+    elapsed = time.monotonic() - start
+    rate = copied / elapsed if elapsed > 0 else 0.0
+    print(f"\r==> Installed {name}: 100% [{'#' * 20}] ({copied} files, {dir_count} dirs)")
+    log(f"Copied {copied} files ({nbytes / (1 << 20):.1f} MiB) in {elapsed:.2f}s ({rate:.0f} files/s)")
+    return copied, dir_count
+
+def _real_key(install_root, path, parents):
+    # Identifies a path by its real parent directory, so /lib/x and /usr/lib/x match when /lib links to usr/lib
+    parent = os.path.dirname(path)
+    if parent not in parents:
+        parents[parent] = os.path.realpath(os.path.join(install_root, parent))
+    return parents[parent], os.path.basename(path)
+
+def remove_stale(name, install_root, stale, keep):
+    # Removes what an older version installed and the new one no longer ships; directories go only once empty
+    if not stale:
+        return 0
+    parents = {}
+    kept = {_real_key(install_root, path, parents) for path in keep}
+    removed = 0
+    with span("remove-stale", pkg=name) as s:
+        for entry in stale:
+            if entry.type == "d" or _real_key(install_root, entry.path, parents) in kept:
+                continue
+            try:
+                os.unlink(os.path.join(install_root, entry.path))
+                removed += 1
+            except (FileNotFoundError, IsADirectoryError):
+                pass
+            except OSError as e:
+                warn(f"Could not remove /{entry.path}: {e}")
+        for entry in sorted((e for e in stale if e.type == "d"), reverse=True):
+            path = os.path.join(install_root, entry.path)
+            if not os.path.islink(path):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+        s.add("files", removed)
+    log(f"Removed {removed} files no longer shipped by {name}")
+    return removed
@@ -0,0 +1,106 @@
+import os
+import select
+import threading
+from src.cache import parse_size
+from src.utils import log, warn
+
+def mem_available():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def default_slots():
+    # LXPKG_JOBS wins; otherwise idle cores, capped by how many jobs fit in available memory
+    if os.getenv("LXPKG_JOBS"):
+        return max(1, int(os.getenv("LXPKG_JOBS")))
+    cpus = os.cpu_count() or 1
+    try:
+        idle = cpus - int(os.getloadavg()[0])
+    except OSError:
+        idle = cpus
+    slots = max(1, min(cpus, idle))
+    available = mem_available()
+    if available is not None:
+        per_job = parse_size(os.getenv("LXPKG_JOB_MEMORY") or "1G")
+        slots = min(slots, max(1, available // per_job))
+    return slots
+
+def package_jobs(pkg):
+    # A recipe can pin its own parallelism, e.g. "1" for packages whose makefiles break under -j
+    try:
+        with open(os.path.join(pkg.dir, "jobs")) as f:
+            return max(1, int(f.read().strip()))
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        warn(f"Invalid jobs file for {pkg.name}, using the shared job pool")
+        return None
+
+class JobServer:
+    # A GNU make jobserver: a pipe holding one token per slot, shared by every build of this invocation
+    def __init__(self, slots):
+        self.slots = slots
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_inheritable(self.read_fd, True)
+        os.set_inheritable(self.write_fd, True)
+        os.write(self.write_fd, b"+" * slots)
+        # A second, non-blocking description of the read end: make clients may flip the shared one either way
+        self._poll_fd = os.open(f"/proc/self/fd/{self.read_fd}", os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+
+    def acquire(self):
+        # make clients may switch the shared pipe to non-blocking, so wait with select
+        while True:
+            select.select([self.read_fd], [], [])
+            try:
+                token = os.read(self.read_fd, 1)
+            except BlockingIOError:
+                continue
+            if token:
+                return token
+
+    def try_acquire(self, limit):
+        # Takes up to limit tokens that are free right now, for tools that can't be jobserver clients
+        # themselves (ninja only speaks the fifo protocol); they go back with release() afterwards
+        tokens = []
+        while len(tokens) < limit:
+            try:
+                token = os.read(self._poll_fd, 1)
+            except BlockingIOError:
+                break
+            if not token:
+                break
+            tokens.append(token)
+        return tokens
+
+    def release(self, token=b"+"):
+        os.write(self.write_fd, token)
+
+    def env(self, jobs=None):
+        # Every build holds one token while it runs; make and cargo draw the rest from the pipe
+        env = dict(os.environ)
+        if jobs:
+            env["MAKEFLAGS"] = f"-j{jobs}"
+        else:
+            auth = f"{self.read_fd},{self.write_fd}"
+            env["MAKEFLAGS"] = f"-j{self.slots} --jobserver-fds={auth} --jobserver-auth={auth}"
+        env["CARGO_MAKEFLAGS"] = env["MAKEFLAGS"]
+        return env
+
+    def pass_fds(self):
+        return (self.read_fd, self.write_fd)
+
+_jobserver = None
+_jobserver_lock = threading.Lock()
+
+def get_jobserver():
+    global _jobserver
+    with _jobserver_lock:
+        if _jobserver is None:
+            _jobserver = JobServer(default_slots())
+            log(f"Using {_jobserver.slots} job slots")
+        return _jobserver
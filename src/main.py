@@ -1,31 +1,25 @@
 #!/usr/bin/env python3
 import sys
 import os
-from src.utils import log, warn, die, print_success, print_info, prompt
-from src.pkg import Package
-from src.fetch import fetch_sources
-from src.build import build_package
-from src.deps import resolve_dependencies
+from src.utils import log, warn, die, print_success, print_info, setup_logging
+
+# Commands that never touch the system; they run without sudo and without loading the build machinery
+READ_ONLY = {"s", "search", "l", "list", "o", "owner", "f", "files", "r", "rdepends", "v", "version", "h", "help"}
 
 # Configuration
-def load_config():
-    config_file = "/etc/lxpkg.conf"
-    defaults = {
-        "LXPKG_PATH": "/usr/src/lxpkg/repo",
-        "LXPKG_COMPRESS": "xz",
-        "LXPKG_SKIP_CHECKSUMS": "0",
-        "LXPKG_STRIP": "1",
-        "LXPKG_COLOR": "1",
-        "LXPKG_VERBOSE": "0"
-    }
-    if not os.path.exists(config_file):
-        log(f"Creating default configuration at {config_file}")
-        with open(config_file, "w") as f:
-            f.write("# lxpkg configuration file\n")
-            for key, value in defaults.items():
-                f.write(f"{key}={value}\n")
-    # Parse key-value pairs
-    config = defaults.copy()
+CONFIG_FILE = "/etc/lxpkg.conf"
+CONFIG_DEFAULTS = {
+    "LXPKG_PATH": "/usr/src/lxpkg/repo",
+    "LXPKG_COMPRESS": "xz",
+    "LXPKG_SKIP_CHECKSUMS": "0",
+    "LXPKG_STRIP": "1",
+    "LXPKG_COLOR": "1",
+    "LXPKG_VERBOSE": "0"
+}
+_config = None
+
+def parse_config(config_file):
+    config = CONFIG_DEFAULTS.copy()
     try:
         with open(config_file) as f:
             for line in f:
@@ -35,88 +29,156 @@ def load_config():
                         key, value = line.split("=", 1)
                         key = key.strip()
                         value = value.strip()
-                        if key in defaults:
+                        if key in CONFIG_DEFAULTS:
                             config[key] = value
                     except ValueError:
                         warn(f"Invalid line in {config_file}: {line}")
+    except FileNotFoundError:
+        pass
     except Exception as e:
         warn(f"Failed to read {config_file}: {e}")
-    for key, value in config.items():
+    return config
+
+def load_config():
+    # Parsed once per process; only root writes the default file, so read-only commands never fail on it
+    global _config
+    if _config is None:
+        if not os.path.exists(CONFIG_FILE) and os.getuid() == 0:
+            log(f"Creating default configuration at {CONFIG_FILE}")
+            with open(CONFIG_FILE, "w") as f:
+                f.write("# lxpkg configuration file\n")
+                for key, value in CONFIG_DEFAULTS.items():
+                    f.write(f"{key}={value}\n")
+        _config = parse_config(CONFIG_FILE)
+    for key, value in _config.items():
         os.environ.setdefault(key, value)
-    if os.environ["LXPKG_COLOR"] == "0" or not sys.stderr.isatty():
-        from src.utils import Fore, Style, ITALIC, RESET
-        Fore = Style = type("", (), {"__getattr__": lambda self, x: ""})()
-        ITALIC = RESET = ""
+    return _config
 
 # Temporary directories
 def setup_temp_dirs():
+    # Every run gets its own directories, so concurrent installs (and the daemon) never share or delete each other's trees
+    import tempfile
     log("Setting up temporary directories...")
     cache_dir = os.getenv("LXPKG_CACHEDIR", "/var/cache/lxpkg")
-    src_dir = f"/tmp/lxpkg-{os.getlogin()}/src"
-    bld_dir = f"/tmp/lxpkg-{os.getlogin()}/build"
-    pkg_dir = f"/tmp/lxpkg-{os.getlogin()}/pkg"
+    work_dir = tempfile.mkdtemp(prefix="lxpkg-", dir=os.getenv("LXPKG_TMPDIR", "/tmp"))
+    src_dir, bld_dir, pkg_dir = (os.path.join(work_dir, name) for name in ("src", "build", "pkg"))
     for dir in [src_dir, bld_dir, pkg_dir]:
-        if os.path.exists(dir):
-            log(f"Cleaning existing directory {dir}")
-            os.system(f"rm -rf {dir}")
         os.makedirs(dir)
     os.makedirs(cache_dir, exist_ok=True)
     sys_db = os.path.join(os.getenv("LXPKG_ROOT", "/"), "var/db/lxpkg/installed")
     os.makedirs(sys_db, exist_ok=True)
-    return cache_dir, src_dir, bld_dir, pkg_dir, sys_db
+    return work_dir, cache_dir, src_dir, bld_dir, pkg_dir, sys_db
+
+def cleanup_temp_dirs(work_dir, success):
+    # Trees of a failed run are kept for inspection
+    if success:
+        import shutil
+        shutil.rmtree(work_dir, ignore_errors=True)
+    else:
+        log(f"Build files kept in {work_dir}")
 
 # Commands
-def search_packages(query):
-    print_info(f"Searching for packages matching '{query}'...")
+def search_packages(args):
+    import json
+    from src.search import get_engine
+    as_json = "--json" in args
+    args = [arg for arg in args if arg != "--json"]
+    if not as_json:
+        print_info(f"Searching for packages matching '{' '.join(args)}'...")
     found = False
-    repo_path = os.getenv("LXPKG_PATH")
-    for root, dirs, _ in os.walk(repo_path):
-        for pkg_name in dirs:
-            if query.lower() in pkg_name.lower():
-                pkg_dir = os.path.join(root, pkg_name)
-                if os.path.exists(os.path.join(pkg_dir, "version")):
-                    try:
-                        pkg = Package(pkg_name)
-                        section = os.path.basename(os.path.dirname(pkg_dir))
-                        print(f" * {pkg_name:<20} Section: {section} Version: {pkg.version}")
-                        found = True
-                    except Exception as e:
-                        warn(f"Skipping {pkg_name}: {e}")
-    if not found:
-        warn(f"No packages found matching '{query}'")
-
-def install_package(pkg_name):
-    print_info(f"Installing package {pkg_name}...")
-    cache_dir, src_dir, bld_dir, pkg_dir, sys_db = setup_temp_dirs()
     try:
-        pkg = Package(pkg_name)
-        deps = resolve_dependencies(pkg)
-        print_success(f"Resolved dependencies: {', '.join(deps)}")
-        for dep in deps:
-            dep_pkg = Package(dep)
-            print_info(f"Processing package {dep}...")
-            fetch_sources(dep_pkg, src_dir)
-            build_package(dep_pkg, src_dir, bld_dir, pkg_dir, sys_db)
-        print_success(f"Successfully installed {pkg_name}")
+        for result in get_engine().search(args):
+            found = True
+            if as_json:
+                print(json.dumps(result), flush=True)
+            else:
+                print(f" * {result['name']:<20} Section: {result['section']} Version: {result['version']}", flush=True)
+    except BrokenPipeError:
+        # Results are streamed, so the reader (e.g. head) may stop early
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return
+    if not found and not as_json:
+        warn(f"No packages found matching '{' '.join(args)}'")
+
+def plan_install(pkg_names, sys_db):
+    # Returns the resolver and the packages that actually have to be built or installed, in order
+    from src.deps import Resolver
+    from src.fingerprint import stale_packages
+    from src.db import open_db
+    from src.binpkg import find_binary_package
+    from src.trace import span
+    resolver = Resolver()
+    order = resolver.resolve(pkg_names)
+    print_success(f"Resolved dependencies: {', '.join(order)}")
+    pkgs = [resolver.packages[name] for name in order]
+    with span("stale-check", packages=len(pkgs)):
+        stale = {pkg.name for pkg in stale_packages(pkgs, open_db(sys_db))}
+        prebuilt = {name for name in stale if find_binary_package(resolver.packages[name])}
+    needed = resolver.prune(pkg_names, stale, prebuilt)
+    if len(needed) < len(order):
+        print_info(f"Skipping {len(order) - len(needed)} up-to-date or unneeded packages")
+    return resolver, needed
+
+def install_packages(pkg_names):
+    from src.daemon import client_install
+    if client_install(pkg_names):
+        return
+    from src.scheduler import Scheduler
+    from src.db import install_lock
+    from src.trace import report
+    print_info(f"Installing {', '.join(pkg_names)}...")
+    work_dir, cache_dir, src_dir, bld_dir, pkg_dir, sys_db = setup_temp_dirs()
+    success = False
+    try:
+        with install_lock(sys_db):
+            resolver, needed = plan_install(pkg_names, sys_db)
+            if needed:
+                Scheduler([resolver.packages[name] for name in needed], src_dir, bld_dir, pkg_dir, sys_db).run()
+        success = True
+        print_success(f"Successfully installed {', '.join(pkg_names)}")
     except Exception as e:
-        die(f"Installation failed for {pkg_name}: {e}")
+        die(f"Installation failed for {', '.join(pkg_names)}: {e}")
+    finally:
+        cleanup_temp_dirs(work_dir, success)
+        report()
+
+def installed_db():
+    from src.db import open_db
+    return open_db(os.path.join(os.getenv("LXPKG_ROOT", "/"), "var/db/lxpkg/installed"))
 
 def list_installed():
     print_info("Listing installed packages...")
-    sys_db = os.path.join(os.getenv("LXPKG_ROOT", "/"), "var/db/lxpkg/installed")
-    if not os.path.exists(sys_db):
+    packages = installed_db().packages()
+    if not packages:
         print_info("No packages installed.")
         return
-    for pkg_name in os.listdir(sys_db):
-        pkg_dir = os.path.join(sys_db, pkg_name)
-        if os.path.isdir(pkg_dir):
-            version_file = os.path.join(pkg_dir, "version")
-            if os.path.exists(version_file):
-                with open(version_file) as f:
-                    version = f.read().strip()
-                print(f" * {pkg_name:<20} Version: {version}")
-            else:
-                warn(f"Skipping {pkg_name}: missing version file")
+    for pkg_name, version, release in packages:
+        print(f" * {pkg_name:<20} Version: {version} {release}")
+
+def show_owner(path):
+    root = os.getenv("LXPKG_ROOT", "/")
+    path = os.path.abspath(path)
+    if root != "/" and path.startswith(root.rstrip("/") + "/"):
+        path = path[len(root.rstrip("/")):]
+    owner = installed_db().owner(path)
+    if owner is None:
+        die(f"{path} is not owned by any package")
+    print(f"{path} is owned by {owner}")
+
+def show_files(pkg_name):
+    db = installed_db()
+    if db.get(pkg_name) is None:
+        die(f"{pkg_name} is not installed")
+    for path in db.files(pkg_name):
+        print(f"/{path}")
+
+def show_rdepends(pkg_name):
+    for name in installed_db().reverse_depends(pkg_name):
+        print(f" * {name}")
+
+def run_daemon():
+    from src.daemon import serve
+    serve()
 
 def show_version():
     print_success("lxpkg version 1.2.7")
@@ -127,8 +189,12 @@ def show_help():
     print("Commands:")
     commands = [
         ("i,install", "Install packages"),
-        ("s,search", "Search for packages"),
+        ("s,search", "Search for packages (section:NAME, version:PREFIX, --json)"),
         ("l,list", "List installed packages"),
+        ("o,owner", "Show which package owns a file"),
+        ("f,files", "List files of an installed package"),
+        ("r,rdepends", "List installed packages depending on a package"),
+        ("daemon", "Serve installs over LXPKG_SOCKET with a warm index and a shared build pool"),
         ("v,version", "Show lxpkg version"),
         ("h,help", "Show this help message")
     ]
@@ -137,8 +203,22 @@ def show_help():
     print("Configuration file: /etc/lxpkg.conf")
     configs = [
         ("LXPKG_PATH", "Repository paths (default: /usr/src/lxpkg/repo)"),
-        ("LXPKG_COMPRESS", "Compression type (gz, xz, zst; default: xz)"),
+        ("LXPKG_COMPRESS", "Binary package compression (gz, xz, zst; default: xz)"),
+        ("LXPKG_STRIP", "Strip ELF files after building (default: 1; a nostrip recipe file opts out)"),
         ("LXPKG_SKIP_CHECKSUMS", "Skip checksum verification (set to 1)"),
+        ("LXPKG_CACHE_SIZE", "Source cache size limit (default: 10G)"),
+        ("LXPKG_DOWNLOAD_JOBS", "Concurrent downloads (default: 8, at most LXPKG_HOST_JOBS per host)"),
+        ("LXPKG_STREAM", "Hash and extract tarballs while downloading (default: 1)"),
+        ("LXPKG_EXTRACT_TOOLS", "Decompress with xz/zstd/pigz/lzip when installed (default: 1)"),
+        ("LXPKG_EXTRACT_JOBS", "Threads writing extracted files (default: 2 per CPU, at most 16)"),
+        ("LXPKG_STAGE", "Source staging (auto, out-of-tree, inplace, link, copy; default: auto)"),
+        ("LXPKG_JOBS", "Job slots shared by all builds (default: idle CPUs, limited by memory)"),
+        ("LXPKG_PARALLEL", "Packages built concurrently (default: CPUs / 4)"),
+        ("LXPKG_FETCH_JOBS", "Packages fetched concurrently (default: 4)"),
+        ("LXPKG_SOCKET", "Socket of the lxpkg daemon; installs go through it while it runs with the same settings (default: /run/lxpkg.sock)"),
+        ("LXPKG_DAEMON", "Use a running daemon for installs (default: 1)"),
+        ("LXPKG_TMPDIR", "Where each run creates its build directories (default: /tmp)"),
+        ("LXPKG_TRACE", "Write a Chrome trace of each install (1 for the cache dir, or a file path)"),
         ("LXPKG_VERBOSE", "Enable verbose logging (set to 1)")
     ]
     for var, desc in configs:
@@ -146,19 +226,26 @@ def show_help():
 
 # Main
 def main():
-    log(f"Command-line arguments: {sys.argv}", verbose_only=True)
     load_config()
+    log(f"Command-line arguments: {sys.argv}", verbose_only=True)
     if len(sys.argv) < 2:
         show_help()
         sys.exit(0)
     command = sys.argv[1].lstrip("-")  # Strip leading dashes
     commands = {
-        "i": lambda: install_package(sys.argv[2]) if len(sys.argv) == 3 else die("install requires a package name"),
-        "install": lambda: install_package(sys.argv[2]) if len(sys.argv) == 3 else die("install requires a package name"),
-        "s": lambda: search_packages(sys.argv[2]) if len(sys.argv) == 3 else search_packages(""),
-        "search": lambda: search_packages(sys.argv[2]) if len(sys.argv) == 3 else search_packages(""),
+        "i": lambda: install_packages(sys.argv[2:]) if len(sys.argv) >= 3 else die("install requires a package name"),
+        "install": lambda: install_packages(sys.argv[2:]) if len(sys.argv) >= 3 else die("install requires a package name"),
+        "s": lambda: search_packages(sys.argv[2:]),
+        "search": lambda: search_packages(sys.argv[2:]),
         "l": list_installed,
         "list": list_installed,
+        "o": lambda: show_owner(sys.argv[2]) if len(sys.argv) == 3 else die("owner requires a file path"),
+        "owner": lambda: show_owner(sys.argv[2]) if len(sys.argv) == 3 else die("owner requires a file path"),
+        "f": lambda: show_files(sys.argv[2]) if len(sys.argv) == 3 else die("files requires a package name"),
+        "files": lambda: show_files(sys.argv[2]) if len(sys.argv) == 3 else die("files requires a package name"),
+        "r": lambda: show_rdepends(sys.argv[2]) if len(sys.argv) == 3 else die("rdepends requires a package name"),
+        "rdepends": lambda: show_rdepends(sys.argv[2]) if len(sys.argv) == 3 else die("rdepends requires a package name"),
+        "daemon": run_daemon,
         "v": show_version,
         "version": show_version,
         "h": show_help,
@@ -166,9 +253,11 @@ def main():
     }
     if command not in commands:
         die(f"Unknown command: {command}")
-    if os.getuid() != 0 and not os.getenv("BOOTSTRAP_LXPKG") and not os.getenv("LXPKG_SUDO"):
-        cmd_su = os.getenv("LXPKG_SU", "sudo")
-        os.execvp(cmd_su, [cmd_su] + sys.argv)
+    if command not in READ_ONLY:
+        if os.getuid() != 0 and not os.getenv("BOOTSTRAP_LXPKG") and not os.getenv("LXPKG_SUDO"):
+            cmd_su = os.getenv("LXPKG_SU", "sudo")
+            os.execvp(cmd_su, [cmd_su] + sys.argv)
+    setup_logging(enabled=command not in READ_ONLY)
     commands[command]()
 
 if __name__ == "__main__":
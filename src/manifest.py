@@ -0,0 +1,127 @@
+import os
+import stat
+from collections import namedtuple
+from src.hashing import hash_files
+
+# One line per entry: path, type (f file, l symlink, d directory), octal mode, size, mtime and the sha256 of the
+# contents (the target for symlinks). Old manifests are bare paths and read back with everything but the path unknown
+Entry = namedtuple("Entry", ("path", "type", "mode", "size", "mtime", "hash"))
+
+UNKNOWN = "-"
+
+def scan_manifest(pkg_path, exclude=()):
+    # Walks pkg_path with scandir; regular files are hashed in parallel at the end
+    entries = []
+    hashed = []
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(pkg_path, rel_dir)) as it:
+            for item in it:
+                rel = os.path.join(rel_dir, item.name)
+                if rel in exclude:
+                    continue
+                st = item.stat(follow_symlinks=False)
+                mode = stat.S_IMODE(st.st_mode)
+                if stat.S_ISDIR(st.st_mode):
+                    entries.append(Entry(rel, "d", mode, 0, int(st.st_mtime), UNKNOWN))
+                    stack.append(rel)
+                elif stat.S_ISLNK(st.st_mode):
+                    entries.append(Entry(rel, "l", mode, st.st_size, int(st.st_mtime), os.readlink(item.path)))
+                elif stat.S_ISREG(st.st_mode):
+                    hashed.append(len(entries))
+                    entries.append(Entry(rel, "f", mode, st.st_size, int(st.st_mtime), UNKNOWN))
+    digests = hash_files([os.path.join(pkg_path, entries[i].path) for i in hashed])
+    for i, digest in zip(hashed, digests):
+        entries[i] = entries[i]._replace(hash=digest)
+    entries.sort()
+    return entries
+
+def format_entry(entry):
+    return f"{entry.path}\t{entry.type}\t{entry.mode:o}\t{entry.size}\t{entry.mtime}\t{entry.hash}\n"
+
+def parse_entry(line):
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) == 6:
+        path, kind, mode, size, mtime, digest = fields
+        return Entry(path, kind, int(mode, 8), int(size), int(mtime), digest)
+    path = fields[0].strip()
+    if path.endswith("/"):
+        return Entry(path.rstrip("/"), "d", None, None, None, UNKNOWN)
+    return Entry(path, UNKNOWN, None, None, None, UNKNOWN)
+
+def save_manifest(manifest_path, entries):
+    tmp = f"{manifest_path}.tmp"
+    with open(tmp, "w") as f:
+        f.writelines(format_entry(entry) for entry in entries)
+    os.replace(tmp, manifest_path)
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return [parse_entry(line) for line in f if line.strip()]
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+def file_paths(entries):
+    return [entry.path for entry in entries if entry.type != "d"]
+
+def install_entries(entries):
+    # The entry list install_files takes: directories end in "/"
+    return [f"{entry.path}/" if entry.type == "d" else entry.path for entry in entries]
+
+def _disk_type(install_root, path):
+    try:
+        mode = os.lstat(os.path.join(install_root, path)).st_mode
+    except OSError:
+        return None
+    return "d" if stat.S_ISDIR(mode) else "l" if stat.S_ISLNK(mode) else "f"
+
+def _installed(install_root, entry):
+    # Cheap check that what the old manifest describes is still on disk; install_file keeps the package's
+    # mtime, so a file edited in place shows up even when its size stays the same
+    try:
+        st = os.lstat(os.path.join(install_root, entry.path))
+    except OSError:
+        return False
+    if entry.type == "l":
+        return stat.S_ISLNK(st.st_mode) and os.readlink(os.path.join(install_root, entry.path)) == entry.hash
+    return (stat.S_ISREG(st.st_mode) and st.st_size == entry.size and stat.S_IMODE(st.st_mode) == entry.mode
+            and int(st.st_mtime) == entry.mtime)
+
+def diff_manifests(old, new, install_root):
+    # Returns (changed, unchanged, stale, retyped): new entries to install, new entries already in place, old
+    # entries to remove afterwards, and old entries that have to go first because the path changes type
+    # (a file becoming a directory, a directory becoming a symlink) along with everything under them
+    if not old:
+        return list(new), [], [], []
+    previous = {entry.path: entry for entry in old}
+    changed = []
+    unchanged = []
+    retyped = set()
+    for entry in new:
+        before = previous.pop(entry.path, None)
+        if before is None:
+            changed.append(entry)
+            continue
+        if before.type == UNKNOWN:
+            before = before._replace(type=_disk_type(install_root, before.path) or UNKNOWN)
+        if before.type != UNKNOWN and before.type != entry.type:
+            retyped.add(before.path)
+            previous[before.path] = before
+            changed.append(entry)
+        elif (entry.type in ("f", "l") and entry.hash != UNKNOWN and before[1:4] == entry[1:4]
+                and before.hash == entry.hash and _installed(install_root, before)):
+            unchanged.append(entry)
+        else:
+            changed.append(entry)
+    if not retyped:
+        return changed, unchanged, list(previous.values()), []
+    stale = []
+    replaced = []
+    for entry in previous.values():
+        parent = entry.path
+        while parent and parent not in retyped:
+            parent = os.path.dirname(parent)
+        (replaced if parent else stale).append(entry)
+    return changed, unchanged, stale, replaced
@@ -0,0 +1,94 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from src.utils import log, print_info, die
+from src.fetch import fetch_sources, prefetch
+from src.download import get_downloader
+from src.build import prepare_package, install_built_package
+from src.binpkg import find_binary_package
+from src.trace import span
+
+def default_workers():
+    # Each build already runs its own parallel make/ninja, so a handful of concurrent packages fills the machine
+    return max(1, (os.cpu_count() or 1) // 4)
+
+def build_graph(pkgs):
+    # Edges point from a package to the dependencies installed before it in this run; pkgs come in
+    # resolver order, so edges that close a cycle are dropped instead of blocking both packages
+    earlier = set()
+    graph = {}
+    for pkg in pkgs:
+        graph[pkg.name] = [dep for dep in pkg.dep_names if dep in earlier]
+        earlier.add(pkg.name)
+    return graph
+
+class Scheduler:
+    def __init__(self, pkgs, src_dir, bld_dir, pkg_dir, sys_db, workers=None, fetch_workers=None):
+        self.pkgs = {pkg.name: pkg for pkg in pkgs}
+        self.order = [pkg.name for pkg in pkgs]
+        self.graph = build_graph(pkgs)
+        self.src_dir = src_dir
+        self.bld_dir = bld_dir
+        self.pkg_dir = pkg_dir
+        self.sys_db = sys_db
+        self.workers = workers or int(os.getenv("LXPKG_PARALLEL") or default_workers())
+        self.fetch_workers = fetch_workers or int(os.getenv("LXPKG_FETCH_JOBS") or 4)
+        self._install_lock = threading.Lock()
+        # Packages with a cached binary package skip fetch and build entirely
+        self.binaries = {pkg.name for pkg in pkgs if find_binary_package(pkg)}
+
+    def _build(self, name):
+        pkg = self.pkgs[name]
+        with span(name, cat="package"):
+            prepare_package(pkg, self.src_dir, self.bld_dir, self.pkg_dir)
+            # Installs write to the same root and database, so they run one at a time
+            with span("install-wait", pkg=name):
+                self._install_lock.acquire()
+            try:
+                install_built_package(pkg, self.pkg_dir, self.sys_db)
+            finally:
+                self._install_lock.release()
+        return name
+
+    def _fetch(self, name):
+        if name not in self.binaries:
+            with span(f"fetch {name}", cat="package"):
+                fetch_sources(self.pkgs[name], self.src_dir)
+        return name
+
+    def run(self):
+        log(f"Scheduling {len(self.order)} packages ({self.workers} build workers, {self.fetch_workers} fetch workers)")
+        fetched = set()
+        installed = set()
+        building = set()
+        prefetch([pkg for pkg in self.pkgs.values() if pkg.name not in self.binaries], self.src_dir)
+        with ThreadPoolExecutor(self.fetch_workers, thread_name_prefix="lxpkg-fetch") as fetch_pool, \
+                ThreadPoolExecutor(self.workers, thread_name_prefix="lxpkg-build") as build_pool:
+            # Fetches are queued in dependency order so the first builds can start as early as possible
+            pending = {fetch_pool.submit(self._fetch, name): "fetch" for name in self.order}
+            try:
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stage = pending.pop(future)
+                        name = future.result()
+                        if stage == "fetch":
+                            fetched.add(name)
+                        else:
+                            building.discard(name)
+                            installed.add(name)
+                            print_info(f"Installed {name} ({len(installed)}/{len(self.order)})")
+                    for name in self.order:
+                        if name in fetched and name not in building and name not in installed \
+                                and all(dep in installed for dep in self.graph[name]):
+                            building.add(name)
+                            pending[build_pool.submit(self._build, name)] = "build"
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+        if len(installed) < len(self.order):
+            # Only reachable if the graph still had a cycle; never report an install that skipped packages
+            die(f"Could not schedule {', '.join(name for name in self.order if name not in installed)}: circular dependencies")
+        get_downloader().report()
+        return self.order
@@ -0,0 +1,140 @@
+import os
+import array
+import bisect
+import marshal
+import logging
+from src.index import get_index, index_path
+
+EXACT = 100
+PREFIX = 80
+WORD = 60
+SUBSTRING = 40
+FUZZY = 30
+
+_engines = {}
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def parse_query(args):
+    # Free terms match names; section:NAME and version:PREFIX narrow the results
+    terms = []
+    filters = {}
+    for arg in args:
+        key, sep, value = arg.partition(":")
+        if sep and key in ("section", "version"):
+            filters[key] = value
+        elif arg:
+            terms.append(arg.lower())
+    return terms, filters
+
+class SearchEngine:
+    # Trigram postings and a sorted name list built from the repository index; nothing is parsed
+    # until a result is about to be shown
+    def __init__(self, index):
+        self.index = index
+        self.names = sorted(index.names(), key=str.lower)
+        self.lower = [name.lower() for name in self.names]
+        self.path = index_path(index.repo)[:-len(".json")] + ".trigrams"
+        self.postings = self._load()
+        if self.postings is None:
+            postings = {}
+            for i, name in enumerate(self.lower):
+                for gram in trigrams(name):
+                    postings.setdefault(gram, array.array("I")).append(i)
+            # Packed arrays load much faster than lists of ints; they are unpacked per query
+            self.postings = {gram: ids.tobytes() for gram, ids in postings.items()}
+            self._save()
+
+    def _load(self):
+        # The postings refer to names by position, so they are only valid for the same name list
+        try:
+            with open(self.path, "rb") as f:
+                names, postings = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return postings if names == self.names else None
+
+    def _save(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                marshal.dump((self.names, self.postings), f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.debug(f"Could not save search index {self.path}: {e}")
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def _score(self, term, name, shared=0, total=0):
+        if name == term:
+            return EXACT
+        if name.startswith(term):
+            return PREFIX
+        pos = name.find(term)
+        if pos > 0:
+            return WORD if not name[pos - 1].isalnum() else SUBSTRING
+        if total and shared * 2 >= total:
+            return FUZZY * shared // total
+        return None
+
+    def match(self, term):
+        # Returns {name index: score} for one term
+        if len(term) < 3:
+            # Too short for trigrams; a prefix range from the sorted list plus a scan for substrings
+            start = bisect.bisect_left(self.lower, term)
+            end = bisect.bisect_left(self.lower, term + "\uffff")
+            scores = {i: self._score(term, self.lower[i]) for i in range(start, end)}
+            for i, name in enumerate(self.lower):
+                if i not in scores and term in name:
+                    scores[i] = self._score(term, name)
+            return scores
+        grams = trigrams(term)
+        counts = {}
+        for gram in grams:
+            for i in array.array("I", self.postings.get(gram, b"")):
+                counts[i] = counts.get(i, 0) + 1
+        scores = {}
+        for i, shared in counts.items():
+            score = self._score(term, self.lower[i], shared, len(grams))
+            if score:
+                scores[i] = score
+        return scores
+
+    def rank(self, terms):
+        # Every term has to match; shorter names win ties, so "gcc" ranks above "gcc-libs"
+        if not terms:
+            return list(range(len(self.names)))
+        scores = self.match(terms[0])
+        for term in terms[1:]:
+            other = self.match(term)
+            scores = {i: score + other[i] for i, score in scores.items() if i in other}
+        return sorted(scores, key=lambda i: (-scores[i], len(self.names[i]), self.lower[i]))
+
+    def search(self, args):
+        # Yields results one at a time in rank order, so callers can print as they go
+        terms, filters = parse_query(args)
+        for i in self.rank(terms):
+            name = self.names[i]
+            entry = self.index.packages.get(name)
+            if entry is None:
+                continue
+            section = os.path.basename(os.path.dirname(entry["dir"]))
+            if "section" in filters and section != filters["section"]:
+                continue
+            entry = self.index.lookup(name)
+            if entry is None:
+                continue
+            if "version" in filters and not entry["version"].startswith(filters["version"]):
+                continue
+            yield {"name": name, "section": section, "version": entry["version"], "release": entry["release"],
+                   "dir": entry["dir"]}
+
+def get_engine(repo=None):
+    repo = os.path.abspath(repo or os.getenv("LXPKG_PATH", "/usr/src/lxpkg/repo"))
+    engine = _engines.get(repo)
+    if engine is None:
+        engine = _engines[repo] = SearchEngine(get_index(repo))
+    return engine
@@ -0,0 +1,64 @@
+import os
+import errno
+import shutil
+from src.utils import log, warn
+
+STAGE_MODES = ("auto", "out-of-tree", "inplace", "link", "copy")
+OUT_OF_TREE = {"meson", "cmake", "cargo"}
+
+def stage_mode(build_system):
+    mode = os.getenv("LXPKG_STAGE", "auto")
+    if mode not in STAGE_MODES:
+        warn(f"Unknown LXPKG_STAGE value '{mode}', using auto")
+        mode = "auto"
+    if mode == "auto":
+        return "out-of-tree" if build_system in OUT_OF_TREE else "inplace"
+    if mode == "out-of-tree" and build_system not in OUT_OF_TREE:
+        return "inplace"
+    return mode
+
+def _clone_file(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dst)
+
+def link_tree(src, dst):
+    # Recreates the directory structure and hardlinks every file; files are copied across filesystems
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for name in dirs:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+            else:
+                _clone_file(path, os.path.join(target, name))
+
+def stage_sources(src_path, build_path, mode):
+    # Returns (work_dir, out_dir): where the build runs and where out-of-tree build systems put their output
+    log(f"Staging sources from {src_path} ({mode})")
+    if mode == "out-of-tree":
+        os.makedirs(build_path, exist_ok=True)
+        return src_path, build_path
+    if mode == "inplace":
+        # The source tree is extracted fresh for every run, so it can become the build tree as-is
+        if os.path.isdir(build_path) and not os.listdir(build_path):
+            os.rmdir(build_path)
+        try:
+            os.rename(src_path, build_path)
+            return build_path, os.path.join(build_path, "build")
+        except OSError as e:
+            warn(f"Cannot move {src_path} to {build_path} ({e}), copying instead")
+            mode = "copy"
+    if mode == "link":
+        link_tree(src_path, build_path)
+    else:
+        shutil.copytree(src_path, build_path, symlinks=True, dirs_exist_ok=True)
+    return build_path, os.path.join(build_path, "build")
@@ -0,0 +1,103 @@
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from src.utils import log, warn, print_info
+from src.trace import span
+
+ELF_MAGIC = b"\x7fELF"
+# e_type -> strip option: executables lose everything, shared objects (and PIEs) keep what the dynamic linker
+# needs, relocatable objects (.o, .ko) only lose debug info
+STRIP_OPTIONS = {2: "--strip-all", 3: "--strip-unneeded", 1: "--strip-debug"}
+BATCH_FILES = 64
+
+def strip_enabled(pkg):
+    # LXPKG_STRIP=0 turns stripping off globally, a "nostrip" file in the recipe for one package
+    return os.getenv("LXPKG_STRIP", "1") == "1" and not os.path.exists(os.path.join(pkg.dir, "nostrip"))
+
+def elf_type(path):
+    try:
+        with open(path, "rb") as f:
+            header = f.read(18)
+    except OSError:
+        return None
+    if len(header) < 18 or not header.startswith(ELF_MAGIC):
+        return None
+    return int.from_bytes(header[16:18], "little" if header[5] == 1 else "big")
+
+def find_elf_files(pkg_path):
+    # Returns {option: [path, ...]} and the extra names of hard-linked files, which strip would otherwise split
+    found = {}
+    links = {}
+    seen = {}
+    stack = [pkg_path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if st.st_size < 18:
+                    continue
+                if st.st_nlink > 1:
+                    key = (st.st_dev, st.st_ino)
+                    if key in seen:
+                        links.setdefault(seen[key], []).append(entry.path)
+                        continue
+                    seen[key] = entry.path
+                option = STRIP_OPTIONS.get(elf_type(entry.path))
+                if option:
+                    found.setdefault(option, []).append(entry.path)
+    elf = {path for paths in found.values() for path in paths}
+    return found, {path: others for path, others in links.items() if path in elf}
+
+def _strip_batch(strip, option, paths):
+    before = {path: os.lstat(path).st_size for path in paths}
+    result = subprocess.run([strip, option] + paths, capture_output=True, text=True)
+    if result.returncode != 0:
+        warn(f"{strip} failed on some files: {result.stderr.strip()}")
+    saved = 0
+    for path, size in before.items():
+        try:
+            saved += size - os.lstat(path).st_size
+        except OSError:
+            pass
+    return saved
+
+def _relink(path, others):
+    # Newer binutils keep hard links intact; older ones replace the stripped name with a new file
+    for other in others:
+        if os.path.samefile(path, other):
+            continue
+        tmp = f"{other}.lxpkg-link"
+        os.link(path, tmp)
+        os.replace(tmp, other)
+
+def strip_package(pkg, pkg_path):
+    # Runs between the build and the manifest, so binary packages and installs only ever see stripped files
+    if not strip_enabled(pkg):
+        log(f"Not stripping {pkg.name}")
+        return 0
+    strip = shutil.which(os.getenv("STRIP", "strip"))
+    if not strip:
+        warn(f"strip not found, installing {pkg.name} unstripped")
+        return 0
+    with span("strip", pkg=pkg.name) as s:
+        found, links = find_elf_files(pkg_path)
+        batches = [(option, paths[i:i + BATCH_FILES]) for option, paths in found.items()
+                   for i in range(0, len(paths), BATCH_FILES)]
+        if not batches:
+            return 0
+        # strip is a separate process per batch, so threads are enough to keep every core busy
+        with ThreadPoolExecutor(min(len(batches), os.cpu_count() or 1)) as pool:
+            saved = sum(pool.map(lambda batch: _strip_batch(strip, *batch), batches))
+        for path, others in links.items():
+            _relink(path, others)
+        files = sum(len(paths) for paths in found.values())
+        s.add("files", files)
+        s.add("bytes", saved)
+    print_info(f"Stripped {files} files in {pkg.name}, saved {saved / (1 << 20):.1f} MiB")
+    return saved
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from src.utils import log, print_info
+
+# Spans are kept in memory for the whole run and written out once at the end
+_events = []
+_counters = {}
+_lock = threading.Lock()
+
+class Span:
+    __slots__ = ("name", "cat", "args", "start")
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = time.perf_counter_ns()
+
+    def add(self, key, value=1):
+        self.args[key] = self.args.get(key, 0) + value
+
+@contextmanager
+def span(name, cat="phase", **args):
+    # Phases (resolve, download, extract, compile, ...) make up the summary; other categories only show in the trace
+    s = Span(name, cat, args)
+    try:
+        yield s
+    finally:
+        end = time.perf_counter_ns()
+        thread = threading.current_thread()
+        with _lock:
+            _events.append((s.name, s.cat, s.start, end - s.start, thread.ident, thread.name, s.args))
+
+def count(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def reset():
+    with _lock:
+        _events.clear()
+        _counters.clear()
+
+def trace_path():
+    # LXPKG_TRACE=1 writes into the cache dir, any other value is taken as the file name
+    value = os.getenv("LXPKG_TRACE", "0")
+    if value in ("", "0"):
+        return None
+    if value == "1":
+        cache_dir = os.getenv("LXPKG_CACHEDIR", "/var/cache/lxpkg")
+        return os.path.join(cache_dir, "traces", f"lxpkg-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.json")
+    return value
+
+def export(path):
+    # Chrome trace event format; opens in chrome://tracing and Perfetto
+    with _lock:
+        events = list(_events)
+        counters = dict(_counters)
+    pid = os.getpid()
+    trace = []
+    threads = {}
+    for name, cat, start, duration, tid, thread_name, args in events:
+        threads[tid] = thread_name
+        trace.append({"name": name, "cat": cat, "ph": "X", "ts": start / 1000, "dur": duration / 1000,
+                      "pid": pid, "tid": tid, "args": args})
+    for tid, thread_name in threads.items():
+        trace.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_name}})
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.{pid}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"traceEvents": trace, "displayTimeUnit": "ms", "otherData": {"counters": counters}}, f)
+    os.replace(tmp, path)
+    return path
+
+def summary():
+    # One row per phase; times are summed over all threads, so they can add up to more than the wall time
+    with _lock:
+        events = [e for e in _events if e[1] == "phase"]
+        counters = dict(_counters)
+    rows = {}
+    for name, _, _, duration, _, _, args in events:
+        row = rows.setdefault(name, {"count": 0, "total": 0, "max": 0, "bytes": 0, "files": 0})
+        row["count"] += 1
+        row["total"] += duration
+        row["max"] = max(row["max"], duration)
+        row["bytes"] += args.get("bytes", 0)
+        row["files"] += args.get("files", 0)
+    lines = [f"{'phase':<16} {'count':>6} {'total':>9} {'max':>9} {'MiB':>9} {'files':>8}"]
+    for name, row in sorted(rows.items(), key=lambda item: -item[1]["total"]):
+        lines.append(f"{name:<16} {row['count']:>6} {row['total'] / 1e9:>8.2f}s {row['max'] / 1e9:>8.2f}s "
+                     f"{row['bytes'] / (1 << 20):>9.1f} {row['files']:>8}")
+    for name, value in sorted(counters.items()):
+        lines.append(f"{name:<16} {value:>6}")
+    return lines
+
+def report():
+    # Writes the trace file if LXPKG_TRACE asks for one and prints the summary table
+    path = trace_path()
+    if path:
+        try:
+            log(f"Wrote trace to {export(path)}")
+        except OSError as e:
+            log(f"Could not write trace {path}: {e}")
+    if path or os.getenv("LXPKG_VERBOSE", "0") == "1":
+        print_info("Time spent per phase:")
+        for line in summary():
+            print(f"  {line}")
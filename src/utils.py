@@ -1,44 +1,120 @@
-import logging
 import sys
 import os
-from colorama import Fore, Style, init
-
-# Initialize colorama
-init(autoreset=True)
+import threading
 
 # ANSI codes
 ITALIC = "\033[3m"
 RESET = "\033[0m"
 
-# Logging setup
-logging.basicConfig(filename="/var/log/lxpkg.log", level=logging.DEBUG, format="%(asctime)s %(levelname)s: %(message)s")
+# Set up on first output, after the configuration has been loaded
+Fore = Style = None
+_logging_ready = False
+_logging_enabled = True
+_setup_lock = threading.Lock()
+_prompt_lock = threading.Lock()
+
+class _NoColor:
+    def __getattr__(self, name):
+        return ""
+
+def setup_output():
+    # colorama is only imported when something is actually printed in color
+    global Fore, Style, ITALIC, RESET
+    if Fore is not None:
+        return
+    with _setup_lock:
+        if Fore is not None:
+            return
+        if os.getenv("LXPKG_COLOR", "1") == "0" or not sys.stdout.isatty():
+            ITALIC = RESET = ""
+            Style = _NoColor()
+            Fore = _NoColor()
+        else:
+            import colorama
+            colorama.init(autoreset=True)
+            Style = colorama.Style
+            Fore = colorama.Fore
+
+def setup_logging(enabled=True):
+    # Read-only commands pass enabled=False and never import logging at all
+    global _logging_ready, _logging_enabled
+    if _logging_ready:
+        return
+    with _setup_lock:
+        if _logging_ready:
+            return
+        _logging_enabled = enabled
+        if enabled:
+            # logging pulls in re, traceback and friends, so it is imported only when it is used
+            import queue
+            import atexit
+            import logging
+            import logging.handlers
+            try:
+                handler = logging.FileHandler("/var/log/lxpkg.log")
+            except OSError:
+                handler = logging.NullHandler()
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
+
+            class QueueHandler(logging.handlers.QueueHandler):
+                # Records are formatted and written by the listener thread; callers only pay for a queue put
+                def prepare(self, record):
+                    return record
+
+            records = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(records, handler)
+            listener.start()
+            atexit.register(listener.stop)
+            root = logging.getLogger()
+            root.addHandler(QueueHandler(records))
+            root.setLevel(logging.DEBUG)
+        _logging_ready = True
+
+def _log(level, msg):
+    setup_logging()
+    if _logging_enabled:
+        import logging
+        logging.getLogger().log(logging.getLevelName(level), msg)
 
 # Colorful output functions
 def log(msg, verbose_only=False):
     if verbose_only and os.getenv("LXPKG_VERBOSE", "0") != "1":
         return
+    setup_output()
     print(f"{Fore.LIGHTBLACK_EX}{ITALIC}==> {msg}{RESET}")
-    logging.info(msg)
+    _log("INFO", msg)
 
 def warn(msg):
+    setup_output()
     print(f"{Fore.YELLOW}{Style.BRIGHT}[WARNING] {msg}{Style.RESET_ALL}")
-    logging.warning(msg)
+    _log("WARNING", msg)
 
 def die(msg, exit_code=1):
+    setup_output()
     print(f"{Fore.RED}{Style.BRIGHT}[ERROR] {msg}{Style.RESET_ALL}")
-    logging.error(msg)
+    _log("ERROR", msg)
     sys.exit(exit_code)
 
 def print_success(msg):
+    setup_output()
     print(f"{Fore.GREEN}{Style.BRIGHT}[SUCCESS] {msg}{Style.RESET_ALL}")
-    logging.info(msg)
+    _log("INFO", msg)
 
 def print_info(msg):
+    setup_output()
     print(f"{Fore.CYAN}{Style.BRIGHT}[INFO] {msg}{Style.RESET_ALL}")
-    logging.info(msg)
+    _log("INFO", msg)
 
 def prompt(msg):
-    print(f"{Fore.GREEN}{Style.BRIGHT}{msg}{Style.RESET_ALL}")
-    print(f"{Fore.LIGHTBLACK_EX}Continue? [y/N] {RESET}", end="")
-    response = input().strip().lower()
+    # Builds and fetches run in worker threads; only one of them may ask at a time
+    setup_output()
+    with _prompt_lock:
+        print(f"{Fore.GREEN}{Style.BRIGHT}{msg}{Style.RESET_ALL}")
+        print(f"{Fore.LIGHTBLACK_EX}Continue? [y/N] {RESET}", end="")
+        try:
+            response = input().strip().lower()
+        except EOFError:
+            # Nobody to ask (the daemon, or stdin closed): the answer is no
+            print()
+            return False
     return response in ["y", "yes"]
@@ -0,0 +1,16 @@
+import hashlib
+import pytest
+
+checksum = pytest.importorskip("src.checksum")
+
+def test_hasher_without_init():
+    hasher = checksum.Hasher.__new__(checksum.Hasher)
+    hasher.update(b"x")
+    assert hasher.hexdigest() == hashlib.sha256(b"x").hexdigest()
+
+def test_hasher_init_resets():
+    hasher = checksum.Hasher(b"ab")
+    hasher.update(b"c")
+    assert hasher.hexdigest() == hashlib.sha256(b"abc").hexdigest()
+    hasher.__init__()
+    assert hasher.hexdigest() == hashlib.sha256(b"").hexdigest()
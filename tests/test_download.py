@@ -0,0 +1,183 @@
+import os
+import re
+import time
+import types
+import hashlib
+import threading
+import http.server
+import pytest
+from src import download
+from src.download import Downloader, DownloadError
+
+DATA = bytes(range(256)) * 4096
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Serves server.files with ETags and Range/If-Range; server.faults holds per-path misbehaviour
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+            fault = server.faults.get(self.path, [None]).pop(0) if server.faults.get(self.path) else None
+        try:
+            self.respond(fault)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def respond(self, fault):
+        server = self.server
+        if self.path in server.redirects:
+            self.send_response(302)
+            self.send_header("Location", server.redirects[self.path])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if fault == "error":
+            self.send_error(503)
+            return
+        if self.path not in server.files:
+            self.send_error(404)
+            return
+        data, etag = server.files[self.path]
+        start = 0
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range", etag) == etag:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            # A server that gets ranges wrong answers from somewhere else than asked
+            shown = start - 1 if fault == "bad-range" else start
+            self.send_header("Content-Range", f"bytes {shown}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        body = data[start:]
+        if fault == "cut":
+            # Dies halfway through the body
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        if fault == "slow":
+            time.sleep(0.2)
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.files = {"/file": (DATA, '"v1"')}
+    httpd.redirects = {}
+    httpd.faults = {}
+    httpd.requests = []
+    httpd.active = 0
+    httpd.peak = 0
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def no_backoff(monkeypatch):
+    # Only the downloader's clock: the server's sleeps stay real
+    monkeypatch.setattr(download, "time", types.SimpleNamespace(sleep=lambda seconds: None, monotonic=time.monotonic))
+
+@pytest.fixture
+def downloader(monkeypatch):
+    no_backoff(monkeypatch)
+    downloader = Downloader(jobs=4, per_host=4, retries=2, timeout=5)
+    yield downloader
+    downloader.close()
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def test_interrupted_download_is_resumed(server, downloader, tmp_path):
+    server.faults["/file"] = ["cut"]
+    dest = tmp_path / "file.part"
+    assert downloader.fetch(f"{server.url}/file", str(dest)) == sha256(DATA)
+    assert dest.read_bytes() == DATA
+    (_, first), (_, second) = server.requests
+    assert "Range" not in first
+    assert second["Range"] == f"bytes={len(DATA) // 2}-"
+    assert second["If-Range"] == '"v1"'
+    assert not os.path.exists(f"{dest}.validator")
+
+def test_partial_file_of_an_older_version_is_replaced(server, downloader, tmp_path):
+    dest = tmp_path / "file.part"
+    dest.write_bytes(b"old contents")
+    (tmp_path / "file.part.validator").write_text('"v0"\n')
+    assert downloader.fetch(f"{server.url}/file", str(dest)) == sha256(DATA)
+    assert dest.read_bytes() == DATA
+
+def test_partial_file_without_validator_is_not_resumed(server, downloader, tmp_path):
+    dest = tmp_path / "file.part"
+    dest.write_bytes(DATA[:100])
+    assert downloader.fetch(f"{server.url}/file", str(dest)) == sha256(DATA)
+    assert "Range" not in server.requests[0][1]
+    assert dest.read_bytes() == DATA
+
+def test_partial_file_larger_than_the_resource_is_replaced(server, downloader, tmp_path):
+    dest = tmp_path / "file.part"
+    dest.write_bytes(DATA + b"trailing")
+    (tmp_path / "file.part.validator").write_text('"v1"\n')
+    assert downloader.fetch(f"{server.url}/file", str(dest)) == sha256(DATA)
+    assert dest.read_bytes() == DATA
+
+def test_complete_partial_file_is_accepted(server, downloader, tmp_path):
+    dest = tmp_path / "file.part"
+    dest.write_bytes(DATA)
+    (tmp_path / "file.part.validator").write_text('"v1"\n')
+    assert downloader.fetch(f"{server.url}/file", str(dest)) == sha256(DATA)
+    assert len(server.requests) == 1
+
+def test_range_from_the_wrong_offset_restarts(server, downloader, tmp_path):
+    server.faults["/file"] = ["cut", "bad-range"]
+    dest = tmp_path / "file.part"
+    assert downloader.fetch(f"{server.url}/file", str(dest)) == sha256(DATA)
+    assert dest.read_bytes() == DATA
+    assert "Range" not in server.requests[-1][1]
+
+def test_redirect_is_followed(server, downloader, tmp_path):
+    server.redirects["/latest"] = "/file"
+    dest = tmp_path / "file.part"
+    assert downloader.fetch(f"{server.url}/latest", str(dest)) == sha256(DATA)
+    assert [path for path, _ in server.requests] == ["/latest", "/file"]
+
+def test_failure_succeeds_on_retry(server, downloader, tmp_path):
+    server.faults["/file"] = ["error"]
+    dest = tmp_path / "file.part"
+    assert downloader.fetch(f"{server.url}/file", str(dest)) == sha256(DATA)
+    assert len(server.requests) == 2
+
+def test_retries_give_up(server, downloader, tmp_path):
+    server.faults["/file"] = ["error"] * 3
+    with pytest.raises(DownloadError):
+        downloader.fetch(f"{server.url}/file", str(tmp_path / "file.part"))
+
+def test_per_host_limit(server, tmp_path):
+    downloader = Downloader(jobs=6, per_host=2, retries=0, timeout=5)
+    server.faults["/file"] = ["slow"] * 6
+    try:
+        futures = [downloader.submit(downloader.fetch, f"{server.url}/file", str(tmp_path / f"{i}.part"))
+                   for i in range(6)]
+        assert {future.result() for future in futures} == {sha256(DATA)}
+    finally:
+        downloader.close()
+    assert server.peak == 2
@@ -0,0 +1,121 @@
+import os
+from src.install import install_files, remove_stale
+from src.manifest import scan_manifest, save_manifest, load_manifest, diff_manifests, install_entries
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+
+def install(pkg, root):
+    # What installing a package does to the tree: the manifest of pkg, with its files copied to root
+    entries = scan_manifest(str(pkg))
+    install_files("test", str(pkg), str(root), install_entries(entries), jobs=1)
+    return entries
+
+def load_manifest_lines(tmp_path, lines):
+    manifest = tmp_path / "manifest"
+    manifest.write_text("".join(f"{line}\n" for line in lines))
+    return load_manifest(str(manifest))
+
+def paths(entries):
+    return sorted(entry.path for entry in entries)
+
+def test_untouched_files_are_unchanged(tmp_path):
+    pkg, root = tmp_path / "pkg", tmp_path / "root"
+    write(f"{pkg}/usr/bin/tool", "tool")
+    os.symlink("tool", pkg / "usr/bin/alias")
+    old = install(pkg, root)
+    changed, unchanged, stale, retyped = diff_manifests(old, scan_manifest(str(pkg)), str(root))
+    assert paths(unchanged) == ["usr/bin/alias", "usr/bin/tool"]
+    assert [entry.type for entry in changed] == ["d", "d"]
+    assert stale == [] and retyped == []
+
+def test_mtime_or_size_differences_are_changed(tmp_path):
+    pkg, root = tmp_path / "pkg", tmp_path / "root"
+    write(f"{pkg}/usr/bin/a", "aaaa")
+    write(f"{pkg}/usr/bin/b", "bbbb")
+    old = install(pkg, root)
+    st = os.stat(root / "usr/bin/a")
+    os.utime(root / "usr/bin/a", (st.st_atime, st.st_mtime + 100))
+    with open(root / "usr/bin/b", "a") as f:
+        f.write("more")
+    os.utime(root / "usr/bin/b", ns=(st.st_atime_ns, os.stat(pkg / "usr/bin/b").st_mtime_ns))
+    changed, unchanged, _, _ = diff_manifests(old, scan_manifest(str(pkg)), str(root))
+    assert unchanged == []
+    assert "usr/bin/a" in paths(changed) and "usr/bin/b" in paths(changed)
+
+def test_file_edited_in_place_is_restored(tmp_path):
+    pkg, root = tmp_path / "pkg", tmp_path / "root"
+    write(f"{pkg}/etc/conf", "original")
+    old = install(pkg, root)
+    # Same size, so only the mtime gives it away
+    with open(root / "etc/conf", "r+") as f:
+        f.write("modified")
+    st = os.stat(root / "etc/conf")
+    os.utime(root / "etc/conf", (st.st_atime, st.st_mtime + 100))
+    changed, unchanged, _, _ = diff_manifests(old, scan_manifest(str(pkg)), str(root))
+    assert "etc/conf" in paths(changed) and unchanged == []
+    install_files("test", str(pkg), str(root), install_entries(changed), jobs=1)
+    assert (root / "etc/conf").read_text() == "original"
+
+def test_file_becoming_a_directory(tmp_path):
+    old_pkg, pkg, root = tmp_path / "old", tmp_path / "pkg", tmp_path / "root"
+    write(f"{old_pkg}/usr/share/thing", "file")
+    old = install(old_pkg, root)
+    write(f"{pkg}/usr/share/thing/data", "data")
+    new = scan_manifest(str(pkg))
+    changed, unchanged, stale, retyped = diff_manifests(old, new, str(root))
+    assert paths(retyped) == ["usr/share/thing"]
+    assert "usr/share/thing" in paths(changed) and stale == []
+    remove_stale("test", str(root), retyped, [entry.path for entry in new if entry.type != "d"])
+    install_files("test", str(pkg), str(root), install_entries(changed), jobs=1)
+    assert (root / "usr/share/thing/data").read_text() == "data"
+
+def test_directory_becoming_a_symlink(tmp_path):
+    old_pkg, pkg, root = tmp_path / "old", tmp_path / "pkg", tmp_path / "root"
+    write(f"{old_pkg}/usr/lib/plugins/one.so", "one")
+    write(f"{old_pkg}/usr/lib/plugins/two.so", "two")
+    old = install(old_pkg, root)
+    write(f"{pkg}/usr/lib/plugins-2/one.so", "one")
+    os.symlink("plugins-2", pkg / "usr/lib/plugins")
+    changed, _, stale, retyped = diff_manifests(old, scan_manifest(str(pkg)), str(root))
+    # Everything under the old directory goes with it, not with the ordinary stale entries
+    assert paths(retyped) == ["usr/lib/plugins", "usr/lib/plugins/one.so", "usr/lib/plugins/two.so"]
+    assert stale == []
+    assert "usr/lib/plugins" in paths(changed)
+
+def test_path_only_manifest(tmp_path):
+    old_pkg, pkg, root = tmp_path / "old", tmp_path / "pkg", tmp_path / "root"
+    write(f"{old_pkg}/usr/bin/tool", "tool")
+    write(f"{old_pkg}/usr/bin/gone", "gone")
+    write(f"{old_pkg}/usr/share/doc", "doc")
+    install(old_pkg, root)
+    old = load_manifest_lines(tmp_path, ["usr/", "usr/bin/", "usr/bin/tool", "usr/bin/gone", "usr/share/", "usr/share/doc"])
+    write(f"{pkg}/usr/bin/tool", "tool")
+    write(f"{pkg}/usr/share/doc/README", "readme")
+    changed, unchanged, stale, retyped = diff_manifests(old, scan_manifest(str(pkg)), str(root))
+    # Nothing to compare against, so every file is installed again; the type of usr/share/doc comes from disk
+    assert unchanged == []
+    assert "usr/bin/tool" in paths(changed)
+    assert paths(stale) == ["usr/bin/gone"]
+    assert paths(retyped) == ["usr/share/doc"]
+
+def test_manifest_round_trip(tmp_path):
+    pkg = tmp_path / "pkg"
+    write(f"{pkg}/usr/bin/tool", "tool")
+    os.symlink("tool", pkg / "usr/bin/alias")
+    entries = scan_manifest(str(pkg))
+    save_manifest(str(tmp_path / "manifest"), entries)
+    assert load_manifest(str(tmp_path / "manifest")) == entries
+
+def test_stale_path_through_a_symlinked_directory_is_kept(tmp_path):
+    root = tmp_path / "root"
+    write(f"{root}/usr/lib/libfoo.so", "foo")
+    write(f"{root}/usr/lib/libold.so", "old")
+    os.symlink("usr/lib", root / "lib")
+    old = load_manifest_lines(tmp_path, ["lib/libfoo.so", "lib/libold.so"])
+    # The new version ships libfoo.so under /usr/lib, which is the same file as /lib/libfoo.so
+    assert remove_stale("test", str(root), old, ["usr/lib/libfoo.so"]) == 1
+    assert (root / "usr/lib/libfoo.so").exists()
+    assert not (root / "usr/lib/libold.so").exists()